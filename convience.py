@@ -1,14 +1,18 @@
-import tempfile
-from extproc import Sh, Cmd, Pipe
+from extproc import Sh, Cmd, Pipe, CAPTURES
 
 def here(string):
     """
     Make a temporary file from a string for use in redirection.
+
+    Each child spawned with it as its stdin reads it from the start, so
+    that a Cmd redirected to it can be run again.  It is closed when it
+    is collected along with the Cmds using it.
     """
+    import tempfile
     t = tempfile.TemporaryFile()
     t.write(string)
     t.seek(0)
-    return t
+    return CAPTURES.add(t, here=True)
 
 def run(cmd, fd={}, e={}, cd=None):
     """
@@ -35,29 +35,1061 @@ Reference:
 
 """
 
+## Only cheap modules are imported here: extproc is imported by many
+## short-lived scripts.  The heavy ones (subprocess, tempfile, shlex,
+## pickle, ...) are imported by the functions that need them.
+import abc
 import collections
+import errno
+import fcntl
+import heapq
 import os
-import shlex
-import subprocess
-import sys
+import select
 import signal
-import tempfile
+import struct
+import sys
 import threading
 import time
-import py_popen
-import pdb
+import weakref
 
 STDIN, STDOUT, STDERR = 0, 1, 2
 DEFAULT_FD = {STDIN: 0, STDOUT: 1, STDERR: 2}
 SILENCE = {0: os.devnull, 1: os.devnull, 2: os.devnull}
 
-PIPE = subprocess.PIPE # should be -1
-_ORIG_STDOUT = subprocess.STDOUT # should be -2
+PIPE = -1 # subprocess.PIPE
+_ORIG_STDOUT = -2 # subprocess.STDOUT
 CLOSE = None
 
 JOBS = []
 
-Capture = collections.namedtuple("Capture", "stdout stderr exit_status")
+class Capture(collections.namedtuple("Capture", "stdout stderr exit_status")):
+    """
+    The captured (stdout, stderr, exit_status) of a child.
+
+    'result' is the return value of a PythonProc's function, or None.
+    'dropped' maps each stream captured with a 'limit' to the number of
+    bytes that were discarded.  'fds' maps the captured fds >= 3 to the
+    files of their output.
+
+    'lines' indexes the lines of stdout, see Lines.
+
+    The capture owns the files of the streams it captured, tracked by
+    CAPTURES until closed: use it as a context manager, or close() it,
+    to release them as soon as they are read.
+
+    >>> with Cmd('echo foo').capture() as c:
+    ...     c.stdout.read()
+    'foo\\n'
+    >>> c.stdout.closed
+    True
+    """
+    def __new__(cls, stdout, stderr, exit_status, result=None, dropped=None,
+                fds=None):
+        self = super(Capture, cls).__new__(cls, stdout, stderr, exit_status)
+        self.result = result
+        self.dropped = dropped or {}
+        self.fds = fds or {}
+        return self
+
+    @classmethod
+    def _make(cls, iterable):
+        return cls(*iterable)
+
+    def _replace(self, **kwds):
+        new = super(Capture, self)._replace(**kwds)
+        new.result, new.dropped, new.fds = self.result, self.dropped, self.fds
+        return new
+
+    @property
+    def lines(self):
+        if self.stdout not in CAPTURES:
+            raise ValueError("stdout was not captured")
+        if '_lines' not in self.__dict__:
+            self._lines = Lines(self.stdout)
+        return self._lines
+
+    def close(self):
+        """
+        Close the captured files, but not the files that the child was
+        redirected to by the caller, and unmap 'lines'.
+        """
+        if '_lines' in self.__dict__:
+            self._lines.close()
+        CAPTURES.close(self.stdout, self.stderr, *self.fds.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Lines(object):
+    """
+    The lines of a file, without their '\n', as a lazy sequence:
+
+    >>> lines = Sh('seq 1 5').capture().lines
+    >>> len(lines), lines[0], lines[-1], lines[1:4][::-1][0]
+    (5, '1', '5', '4')
+
+    Only the offsets of the newlines are computed, in one pass over the
+    file and stored in an array; a line is read when it is indexed, and
+    slicing returns another Lines without reading anything.  Real files
+    are mmap'ed, other file objects are read into memory.  close() unmaps
+    the file, for this Lines and the slices of it alike.
+    """
+    def __init__(self, f, _view=None):
+        if _view is not None:
+            self._data, self._ends, self._range = _view
+            return
+        self._data = _map_file(f)
+        self._ends = _newline_offsets(self._data)
+        count = len(self._ends)
+        if len(self._data) and self._data[len(self._data) - 1] != '\n':
+            ## a last line without a newline
+            self._ends.append(len(self._data))
+            count += 1
+        self._range = (0, 1, count)
+
+    def __len__(self):
+        return self._range[2]
+
+    def _line(self, row):
+        start = self._ends[row - 1] + 1 if row else 0
+        return self._data[start:self._ends[row]]
+
+    def __getitem__(self, i):
+        first, step, count = self._range
+        if isinstance(i, slice):
+            start, stop, stride = i.indices(count)
+            n = max(0, (stop - start + stride - (1 if stride > 0 else -1))
+                       // stride)
+            return Lines(None, _view=(self._data, self._ends,
+                                      (first + start * step, step * stride, n)))
+        if i < 0:
+            i += count
+        if not 0 <= i < count:
+            raise IndexError("line index out of range")
+        return self._line(first + i * step)
+
+    def __iter__(self):
+        first, step, count = self._range
+        for i in xrange(count):
+            yield self._line(first + i * step)
+
+    def __reversed__(self):
+        first, step, count = self._range
+        for i in xrange(count - 1, -1, -1):
+            yield self._line(first + i * step)
+
+    def __repr__(self):
+        return "<Lines of %d lines>" % len(self)
+
+    def close(self):
+        if hasattr(self._data, 'close'):
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _map_file(f):
+    """
+    Return the content of file 'f' as an mmap, or a string when it cannot
+    be mapped.
+    """
+    import mmap
+    try:
+        fd = f.fileno()
+        if os.fstat(fd).st_size:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        pass
+    f.seek(0)
+    data = f.read()
+    f.seek(0)
+    return data
+
+def _newline_offsets(data, chunk_size=1 << 20):
+    """
+    Return an array of the offsets of the newlines of 'data'.
+    """
+    import array
+    ends = array.array('L')
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None and len(data):
+        found = numpy.flatnonzero(numpy.frombuffer(data, numpy.uint8) == 10)
+        ends.fromstring(found.astype('u%d' % ends.itemsize).tostring())
+        return ends
+    append = ends.append
+    for base in xrange(0, len(data), chunk_size):
+        chunk = data[base:base + chunk_size]
+        find = chunk.find
+        i = find('\n')
+        while i >= 0:
+            append(base + i)
+            i = find('\n', i + 1)
+    return ends
+
+class _CaptureSink(object):
+    """
+    A pipe capturing one stream of the children, read by the parent as
+    the children write it: they write to fileno(), and _drain() feeds
+    what they wrote to the sink.
+
+    The sinks of a capture also have getfile(), which returns a file
+    object of the captured output.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    # (pid, stream name) of the only writer, while a tracer awaits it
+    traced = None
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self.write_fd
+
+    def close_writer(self):
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+    def close(self):
+        """
+        Close both ends of the pipe, when no child could be spawned to
+        write to it.
+        """
+        self.close_writer()
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+
+    @abc.abstractmethod
+    def feed(self, data):
+        """
+        Take 'data', read from the pipe.
+        """
+
+    def finish(self):
+        """
+        Called once all the writers have closed the pipe.
+        """
+        pass
+
+class _BoundedSink(_CaptureSink):
+    """
+    A capture of which the parent keeps at most 'limit' bytes: the first
+    ones ('head'), the last ones ('tail'), or half of each ('both').  The
+    rest is read and discarded as it comes, and counted in 'dropped', so
+    that the children never block on a full pipe.
+    """
+    def __init__(self, limit, keep='tail'):
+        if keep not in ('head', 'tail', 'both'):
+            raise ValueError(
+                "keep must be 'head', 'tail' or 'both', got %r" % (keep,))
+        if limit < 0:
+            raise ValueError("limit must be >= 0, got %r" % (limit,))
+        self.head_limit = dict(head=limit, tail=0,
+                               both=limit - limit // 2)[keep]
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+        super(_BoundedSink, self).__init__()
+
+    def feed(self, data):
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not self.tail_limit:
+            self.dropped += len(data)
+            return
+        self.tail += data
+        excess = len(self.tail) - self.tail_limit
+        if excess > 0:
+            del self.tail[:excess]
+            self.dropped += excess
+
+    def getfile(self):
+        """
+        Return a file holding the kept bytes, head first.
+        """
+        import tempfile
+        f = tempfile.TemporaryFile()
+        f.write(self.head)
+        f.write(self.tail)
+        f.seek(0)
+        return f
+
+def _compression_codec(name):
+    """
+    Return the (compressor, decompressor) factories of 'name'.
+    """
+    if name in ('zlib', 'gzip'):
+        import zlib
+        ## gzip is deflate with a gzip header and trailer (wbits + 16)
+        wbits = zlib.MAX_WBITS + (16 if name == 'gzip' else 0)
+        return (lambda: zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                         zlib.DEFLATED, wbits),
+                lambda: zlib.decompressobj(wbits))
+    elif name == 'lzma':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise ValueError(
+                    "compress='lzma' needs the backports.lzma package")
+        return lzma.LZMACompressor, lzma.LZMADecompressor
+    raise ValueError(
+        "compress must be 'zlib', 'gzip' or 'lzma', got %r" % (name,))
+
+class _CompressedSink(_CaptureSink):
+    """
+    A capture compressed with 'compress' into a temporary file as it is
+    read, so that it takes its compressed size on disk.
+    """
+    def __init__(self, compress):
+        self.codec = compress
+        compressor, self.decompressor = _compression_codec(compress)
+        self.compressor = compressor()
+        import tempfile
+        self.file = tempfile.TemporaryFile()
+        self.raw_size = 0
+        self.start_time = time.time()
+        super(_CompressedSink, self).__init__()
+
+    def feed(self, data):
+        self.raw_size += len(data)
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        super(_CompressedSink, self).close()
+        self.file.close()
+
+    def finish(self):
+        self.file.write(self.compressor.flush())
+        self.seconds = time.time() - self.start_time
+
+    def getfile(self):
+        """
+        Return a file decompressing the capture as it is read.
+        """
+        size = self.file.tell()
+        stats = dict(
+            codec=self.codec, raw_size=self.raw_size, compressed_size=size,
+            ratio=float(self.raw_size) / size if size else 0.0,
+            seconds=self.seconds,
+            throughput=self.raw_size / self.seconds if self.seconds else 0.0)
+        return _DecompressedFile(self.file, self.decompressor, stats)
+
+class _DecompressedFile(object):
+    """
+    A read-only file of the decompressed content of file 'f'.
+
+    'stats' holds the codec, the raw and compressed sizes in bytes, their
+    'ratio', and the 'seconds' and 'throughput' (raw bytes per second) of
+    the capture.
+    """
+    def __init__(self, f, decompressor, stats, chunk_size=8192):
+        self.raw = f
+        self.decompressor = decompressor
+        self.stats = stats
+        self.chunk_size = chunk_size
+        self.seek(0)
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+    def close(self):
+        self.raw.close()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        """
+        Seek to 'offset', by decompressing from the start again when
+        seeking backwards.
+        """
+        if whence == 1:
+            offset += self.pos
+        elif whence != 0:
+            raise IOError("can only seek from the start or current position")
+        if not hasattr(self, 'pos') or offset < self.pos:
+            self.raw.seek(0)
+            self._d = self.decompressor()
+            self._buf, self._off = '', 0
+            self.pos = 0
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, self.chunk_size)):
+                break
+
+    def _fill(self):
+        """
+        Decompress one more chunk into the buffer, once the previous one
+        has been read, False at EOF.
+        """
+        if self._d is None:
+            return False
+        data = self.raw.read(self.chunk_size)
+        if data:
+            self._buf = self._d.decompress(data)
+        else:
+            self._buf = self._d.flush() if hasattr(self._d, 'flush') else ''
+            self._d = None
+        self._off = 0
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        n = 0
+        while size < 0 or n < size:
+            if self._off == len(self._buf) and not self._fill():
+                break
+            end = len(self._buf)
+            if size >= 0:
+                end = min(end, self._off + size - n)
+            chunks.append(self._buf[self._off:end])
+            n += end - self._off
+            self._off = end
+        self.pos += n
+        return ''.join(chunks)
+
+    def readline(self, size=-1):
+        chunks = []
+        n = 0
+        while size < 0 or n < size:
+            if self._off == len(self._buf) and not self._fill():
+                break
+            i = self._buf.find('\n', self._off)
+            end = len(self._buf) if i < 0 else i + 1
+            if size >= 0:
+                end = min(end, self._off + size - n)
+            chunks.append(self._buf[self._off:end])
+            n += end - self._off
+            self._off = end
+            if 0 <= i < end:
+                break
+        self.pos += n
+        return ''.join(chunks)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+class _LineSink(_CaptureSink):
+    """
+    A stream of the children whose lines are handed to 'callback' in
+    batches, as lists of strings without their newline: as soon as
+    'batch_lines' lines are in, 'batch_ms' milliseconds after the first
+    line of a batch came in, and at EOF.
+
+    If 'callback' raises, the rest of the output is discarded and
+    'error' holds the exc_info, to be raised again by wait().
+    """
+    def __init__(self, callback, batch_lines=100, batch_ms=50):
+        self.callback = callback
+        self.batch_lines = batch_lines
+        self.batch_ms = batch_ms
+        self.partial = ''
+        self.lines = []
+        self.deadline = None
+        self.error = None
+        self.done = threading.Event()
+        super(_LineSink, self).__init__()
+
+    def feed(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        if not lines:
+            return
+        if not self.lines:
+            self.deadline = time.time() + self.batch_ms / 1000.0
+        self.lines.extend(lines)
+        while len(self.lines) >= self.batch_lines:
+            batch = self.lines[:self.batch_lines]
+            self.lines = self.lines[self.batch_lines:]
+            self._deliver(batch)
+        if not self.lines:
+            self.deadline = None
+
+    def flush(self):
+        if self.lines:
+            batch, self.lines = self.lines, []
+            self._deliver(batch)
+        self.deadline = None
+
+    def finish(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ''
+        self.flush()
+        self.done.set()
+
+    def _deliver(self, batch):
+        ## a failing callback must not stop the loop of the other jobs
+        if self.error is not None:
+            return
+        try:
+            self.callback(batch)
+        except Exception:
+            self.error = sys.exc_info()
+
+class CaptureRegistry(object):
+    """
+    The capture buffers of this process that are still open: the files
+    of the captures and of here(), see CAPTURES.
+
+    'budget', if not None, is the number of bytes that they may take
+    altogether.  The output of a capture without a 'limit' or 'compress'
+    beyond the budget is then discarded as the child writes it, and
+    counted in the 'dropped' dict of the Capture.
+
+    The budget is checked against a running total of the bytes tracked,
+    which only grows as captures are written and shrinks as they are
+    closed through close().  The files closed otherwise or collected are
+    only accounted for by a full size() when the budget seems exhausted.
+    """
+    def __init__(self, budget=None):
+        self._lock = threading.Lock()
+        self._captures = weakref.WeakSet()
+        self._here = weakref.WeakSet()
+        self._total = 0
+        self.budget = budget
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        with self._lock:
+            self._budget = budget
+            self._total = self.size()
+
+    def add(self, f, here=False):
+        """
+        Track 'f', a capture file or, if 'here', the stdin of children
+        that is read from the start by each of them.  Return 'f'.
+        """
+        with self._lock:
+            (self._here if here else self._captures).add(f)
+            self._total += _file_size(f)
+        return f
+
+    def __contains__(self, f):
+        return f in self._captures or f in self._here
+
+    def is_here(self, f):
+        return f in self._here
+
+    def buffers(self):
+        """
+        Return the open files tracked.
+        """
+        return [f for f in list(self._captures) + list(self._here)
+                if not f.closed]
+
+    def size(self):
+        """
+        Return the total size of the open files tracked, in bytes.
+        """
+        return sum(_file_size(f) for f in self.buffers())
+
+    def close(self, *files):
+        """
+        Close those of 'files' that are tracked.
+        """
+        for f in files:
+            if f in self and not f.closed:
+                with self._lock:
+                    self._total = max(0, self._total - _file_size(f))
+                    f.close()
+
+    def reserve(self, f, data):
+        """
+        Append to 'f', a tracked file, the part of 'data' within the
+        budget.  Return the number of bytes discarded.
+        """
+        with self._lock:
+            kept = len(data)
+            if self._budget is not None:
+                if self._total + kept > self._budget:
+                    ## the files closed or collected since may have given
+                    ## some room back
+                    self._total = self.size()
+                kept = max(0, min(kept, self._budget - self._total))
+            fd = f.fileno()
+            view = data[:kept]
+            while view:
+                view = view[os.write(fd, view):]
+            self._total += kept
+        return len(data) - kept
+
+def _file_size(f):
+    try:
+        return os.fstat(getattr(f, 'raw', f).fileno()).st_size
+    except (OSError, ValueError):
+        return 0
+
+CAPTURES = CaptureRegistry()
+
+class _BudgetSink(_CaptureSink):
+    """
+    A capture to a temporary file of what fits in CAPTURES.budget.
+    """
+    def __init__(self):
+        import tempfile
+        self.file = CAPTURES.add(tempfile.TemporaryFile())
+        self.dropped = 0
+        super(_BudgetSink, self).__init__()
+
+    def feed(self, data):
+        self.dropped += CAPTURES.reserve(self.file, data)
+
+    def close(self):
+        super(_BudgetSink, self).close()
+        CAPTURES.close(self.file)
+
+    def getfile(self):
+        return self.file
+
+def _capture_target(limit=None, keep='tail', compress=None, **kwargs):
+    """
+    Return what a captured stream of a child is redirected to.
+    """
+    if limit is not None and compress is not None:
+        raise ValueError("cannot both limit and compress a capture")
+    if limit is not None:
+        return _BoundedSink(limit, keep)
+    elif compress is not None:
+        return _CompressedSink(compress)
+    elif CAPTURES.budget is not None:
+        return _BudgetSink()
+    import tempfile
+    return CAPTURES.add(tempfile.TemporaryFile())
+
+def _drain(sinks):
+    """
+    Read the pipes of 'sinks' until all of their writers have exited.
+    """
+    for sink in sinks:
+        sink.close_writer()
+    readers = dict((sink.read_fd, sink) for sink in sinks)
+    ## not select(): the fds may be above FD_SETSIZE
+    poller = select.poll()
+    for fd in readers:
+        poller.register(fd, select.POLLIN)
+    while readers:
+        try:
+            ready = poller.poll()
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, _ in ready:
+            data = os.read(fd, 65536)
+            if data:
+                if _TRACER is not None and readers[fd].traced:
+                    _TRACER.output(readers[fd])
+                readers[fd].feed(data)
+            else:
+                poller.unregister(fd)
+                os.close(fd)
+                readers.pop(fd).finish()
+
+## Linux prctl option, not exported by Python
+PR_SET_CHILD_SUBREAPER = 36
+_SUBREAPER = False
+
+def subreaper(enable=True):
+    """
+    Make this process the subreaper of its descendants (Linux >= 3.4):
+    the orphans of our children are reparented to us rather than to
+    init.  Killing a job run with pgroup=True then also reaps whatever
+    it left behind in its process group.
+    """
+    global _SUBREAPER
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, int(bool(enable)), 0, 0, 0):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    _SUBREAPER = bool(enable)
+
+def _killpg(pgid, sig):
+    ## never our own group, whatever went wrong in setting up 'pgid'
+    if pgid and pgid != os.getpgrp():
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            pass
+
+def _reap_orphans(pgid, exclude=(), block=True, timeout=1.0):
+    """
+    Reap the processes of group 'pgid' reparented to us as a subreaper,
+    other than the children in 'exclude' that Popen objects will wait for.
+
+    With 'block', the group has just been sent SIGKILL: wait up to
+    'timeout' seconds for its members whose parents are dying in the
+    group too, and so are about to be reparented to us.
+    """
+    if not (_SUBREAPER and pgid):
+        return
+    me = os.getpid()
+    deadline = time.time() + timeout
+    while True:
+        parents = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit() or int(name) in exclude:
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    stat = f.read()
+            except IOError:
+                continue
+            ## the fields after the parenthesized command name
+            fields = stat[stat.rindex(')') + 2:].split()
+            if int(fields[2]) == pgid:
+                parents[int(name)] = int(fields[1])
+        orphans = [pid for pid, ppid in parents.iteritems() if ppid == me]
+        for pid in orphans:
+            try:
+                os.waitpid(pid, 0 if block else os.WNOHANG)
+            except OSError:
+                pass
+        pending = [pid for pid, ppid in parents.iteritems()
+                   if ppid in parents or ppid in exclude]
+        if not (block and pending) or time.time() > deadline:
+            return
+        if not orphans:
+            time.sleep(0.001)
+
+class _IOLoop(object):
+    """
+    The thread that reads the followed streams of all the spawned jobs,
+    see spawn(on_stdout=...), through a single epoll (or poll) object.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._mask = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self._scale = 1.0
+        else:
+            self._poller = select.poll()
+            self._mask = select.POLLIN | select.POLLHUP | select.POLLERR
+            self._scale = 1000.0
+        self._sinks = {}
+        self._added = []
+        self._lock = threading.Lock()
+        ## a byte written here wakes the loop up to register new sinks
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wakeup_read, self._mask)
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, sink):
+        """
+        Follow 'sink', of which the parent has closed its writing end.
+        """
+        with self._lock:
+            self._added.append(sink)
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError:
+            ## full: the loop has wake-ups pending anyway
+            pass
+
+    def _timeout(self):
+        deadlines = [sink.deadline for sink in self._sinks.itervalues()
+                     if sink.deadline is not None]
+        if not deadlines:
+            return -1
+        return max(0, min(deadlines) - time.time()) * self._scale
+
+    def _loop(self):
+        while True:
+            try:
+                events = self._poller.poll(self._timeout())
+            except (EnvironmentError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                if fd == self._wakeup_read:
+                    try:
+                        os.read(fd, 4096)
+                    except OSError:
+                        pass
+                    with self._lock:
+                        added, self._added = self._added, []
+                    for sink in added:
+                        self._sinks[sink.read_fd] = sink
+                        self._poller.register(sink.read_fd, self._mask)
+                    continue
+                sink = self._sinks.get(fd)
+                if sink is None:
+                    continue
+                data = os.read(fd, 65536)
+                if data:
+                    if _TRACER is not None and sink.traced:
+                        _TRACER.output(sink)
+                    sink.feed(data)
+                else:
+                    self._poller.unregister(fd)
+                    del self._sinks[fd]
+                    os.close(fd)
+                    sink.finish()
+            now = time.time()
+            for sink in self._sinks.values():
+                if sink.deadline is not None and sink.deadline <= now:
+                    sink.flush()
+
+_IO_LOOP = []
+
+def _follow(sinks):
+    """
+    Hand 'sinks' over to the I/O loop, started on first use.
+    """
+    if not sinks:
+        return
+    if not _IO_LOOP:
+        _IO_LOOP.append(_IOLoop())
+    for sink in sinks:
+        sink.close_writer()
+        _IO_LOOP[0].add(sink)
+
+_TRACER = None
+
+class Tracer(object):
+    """
+    The timeline of the children spawned while tracing, see trace():
+    when each was forked, had exec'ed (its Popen returned), first wrote
+    output, if extproc reads it or monitors its pipe, and was reaped.
+    """
+    def __init__(self, max_events=None):
+        """
+        :param max_events: keep only the last 'max_events' events.
+        """
+        self.events = collections.deque(maxlen=max_events)
+        self._heard = set()
+
+    def spawned(self, cmd, p, forked, popen_args):
+        pid = getattr(p, 'pid', None)
+        if pid is None:
+            return
+        parent = getattr(cmd, 'parent', lambda: None)()
+        argv = popen_args.get('args')
+        if not isinstance(argv, (list, tuple)):
+            argv = None
+        self.events.append((
+            'spawn', forked, time.time(), pid, _job_name(cmd), argv,
+            _job_name(parent) if parent is not None else None))
+        for stream in ('stdout', 'stderr'):
+            sink = popen_args.get(stream)
+            if isinstance(sink, _CaptureSink):
+                ## a sink shared by several stages is not told apart
+                sink.traced = (pid, stream) if sink.traced is None else False
+        if hasattr(p, 'on_exit'):
+            p.on_exit = self.exited
+
+    def exited(self, p):
+        self.events.append(('exit', time.time(), p.pid, p.returncode))
+
+    def output(self, sink_or_pid, stream='stdout'):
+        """
+        Record the first output of a child, given the sink it writes to
+        or its pid.
+        """
+        if isinstance(sink_or_pid, _CaptureSink):
+            (pid, stream), sink_or_pid.traced = sink_or_pid.traced, False
+        else:
+            pid = sink_or_pid
+        if (pid, stream) not in self._heard:
+            self._heard.add((pid, stream))
+            self.events.append(('output', time.time(), pid, stream))
+
+    def trace_events(self):
+        """
+        Return the events as a list of Chrome trace events: a slice per
+        child, from fork to reaping, on a track of its own, with a
+        nested 'fork/exec' slice and instant events for its first output.
+        """
+        me = os.getpid()
+        trace_events = []
+        spawned = {}
+
+        def lifetime(spawn, end, returncode):
+            _, forked, execed, pid, name, argv, parent = spawn
+            trace_events.extend([
+                dict(name='thread_name', ph='M', pid=me, tid=pid,
+                     args=dict(name='%s [%d]' % (name, pid))),
+                dict(name=name, cat='process', ph='X', pid=me, tid=pid,
+                     ts=forked * 1e6, dur=(end - forked) * 1e6,
+                     args=dict(pid=pid, argv=argv, pipeline=parent,
+                               exit_status=returncode)),
+                dict(name='fork/exec', cat='process', ph='X', pid=me,
+                     tid=pid, ts=forked * 1e6, dur=(execed - forked) * 1e6)])
+
+        for event in list(self.events):
+            if event[0] == 'spawn':
+                spawned[event[3]] = event
+            elif event[0] == 'output':
+                _, t, pid, stream = event
+                trace_events.append(dict(
+                    name='first output on %s' % stream, cat='output',
+                    ph='i', s='t', pid=me, tid=pid, ts=t * 1e6))
+            else:
+                _, t, pid, returncode = event
+                if pid in spawned:
+                    lifetime(spawned.pop(pid), t, returncode)
+                else:
+                    trace_events.append(dict(
+                        name='exit', cat='process', ph='i', s='t', pid=me,
+                        tid=pid, ts=t * 1e6, args=dict(exit_status=returncode)))
+        ## still running
+        now = time.time()
+        for spawn in spawned.itervalues():
+            lifetime(spawn, now, None)
+        return trace_events
+
+    def export(self, f):
+        """
+        Write the events as Chrome trace-event JSON, for Perfetto or
+        about:tracing, to the file object or path 'f'.
+        """
+        import json
+        if isinstance(f, basestring):
+            with open(f, 'w') as f:
+                return self.export(f)
+        json.dump(dict(traceEvents=self.trace_events(),
+                       displayTimeUnit='ms'), f)
+
+def trace(enable=True, max_events=None):
+    """
+    Record the lifetimes of the children spawned from now on in a new
+    Tracer, and return it.  trace(False) stops and returns the current
+    tracer, if any.  When not tracing, extproc only tests a global.
+
+    >>> tracer = trace()
+    >>> Cmd('echo hi').capture(limit=10).stdout.read()
+    'hi\\n'
+    >>> trace(False) is tracer
+    True
+    >>> sorted(e['name'] for e in tracer.trace_events() if e['ph'] != 'M')
+    ['echo hi', 'first output on stdout', 'fork/exec']
+    """
+    global _TRACER
+    tracer = _TRACER
+    _TRACER = Tracer(max_events) if enable else None
+    return _TRACER or tracer
+
+class ExecutableCache(object):
+    """
+    A process-wide cache of the PATH lookups of Cmd executables.
+
+    Entries are keyed by the PATH string, so a different PATH never
+    sees stale results.  The mtimes of the PATH directories are checked
+    at most once every 'ttl' seconds rather than on every lookup, so for
+    up to 'ttl' seconds after a PATH directory changes, e.g. a binary is
+    removed or shadowed, the old path is still returned and the spawn
+    fails or runs the old binary.  A cached binary that is no longer
+    executable, as after a chmod, which leaves the mtime of its directory
+    alone, is looked up again right away.  Call refresh() to drop the
+    cache immediately.
+
+    'stats' counts the hits, misses and invalidations of the cache.
+    """
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self.stats = dict(hits=0, misses=0, invalidations=0)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Forget every cached lookup.
+        """
+        self._cache = {}
+        self._mtimes = {}
+        self._checked = {}
+
+    def _validate(self, path):
+        now = time.time()
+        if now - self._checked.get(path, 0) < self.ttl:
+            return
+        mtimes = []
+        for d in path.split(os.pathsep):
+            try:
+                mtimes.append(os.stat(d).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        if self._mtimes.get(path, mtimes) != mtimes:
+            self.stats['invalidations'] += 1
+            for key in [k for k in self._cache if k[0] == path]:
+                del self._cache[key]
+        self._mtimes[path] = mtimes
+        self._checked[path] = now
+
+    def resolve(self, name, path=None, cwd=None):
+        """
+        Return the full path of the executable that execvp would run
+        for 'name' with the given PATH, or raise OSError(ENOENT).
+
+        A name containing a slash is returned unchanged.  Relative PATH
+        entries are looked up from 'cwd' and are never cached.
+        """
+        if os.sep in name:
+            return name
+        if path is None:
+            path = os.environ.get('PATH', os.defpath)
+        self._validate(path)
+        executable = self._cache.get((path, name))
+        if executable is not None and os.access(executable, os.X_OK):
+            self.stats['hits'] += 1
+            return executable
+        self.stats['misses'] += 1
+        for d in path.split(os.pathsep):
+            executable = os.path.join(d or os.curdir, name)
+            if not os.path.isabs(executable):
+                executable = os.path.join(cwd or os.getcwd(), executable)
+                if _is_executable(executable):
+                    return executable
+            elif _is_executable(executable):
+                self._cache[(path, name)] = executable
+                return executable
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+def _is_executable(f):
+    return os.path.isfile(f) and os.access(f, os.X_OK)
+
+EXECUTABLES = ExecutableCache()
 
 def _is_fileno(n, f):
     return (f is n) or (hasattr(f, 'fileno') and f.fileno() == n)
@@ -73,25 +1105,117 @@ class InvalidArgsException(Exception):
 
 class Process(object):
 
-    def _check_redirect_target(self, fd_target, fd_dict):
+    def _check_redirect_target(self, fd_target, fd_dict, **kwargs):
         ret_fd_dict = {}
-        if _is_fileno(fd_target, fd_dict[fd_target]):
-            ret_fd_dict[fd_target] = tempfile.TemporaryFile()
+        ## fds >= 3 are not redirected unless in fd_dict
+        if ((fd_target > 2 and fd_target not in fd_dict) or
+            (fd_target <= 2 and _is_fileno(fd_target, fd_dict[fd_target]))):
+            ret_fd_dict[fd_target] = _capture_target(**kwargs)
             return ret_fd_dict
         else:
             raise ValueError(
                 "cannot capture the child's %d stream: it was redirected to %r"
-                % (fd_target,  _name_or_self(fd_target)))
+                % (fd_target,  _name_or_self(fd_dict[fd_target])))
 
-    def _verify_capture_args(self, fd_a, fd_dict):
+    def _verify_capture_args(self, fd_a, fd_dict, **kwargs):
         ret_fd_dict = {}
-        if fd_a not in [1,2]:
-            raise NotImplementedError(
-                "can only capture a subset of fd [1, 2] for now")
+        if not isinstance(fd_a, int) or fd_a < 1:
+            raise ValueError("can only capture fds >= 1, not %r" % (fd_a,))
 
-        ret_fd_dict = self._check_redirect_target(fd_a, fd_dict)
+        ret_fd_dict = self._check_redirect_target(fd_a, fd_dict, **kwargs)
         return ret_fd_dict
 
+    def _abort_capture(self, fd, saved):
+        """
+        Close the captures of streams 'fd' made for children that could
+        not be spawned, and give the streams back the targets of 'saved',
+        a copy of fd_objs from before.
+        """
+        for n in fd:
+            target = self.fd_objs.get(n)
+            if target is saved.get(n):
+                continue
+            if isinstance(target, _CaptureSink):
+                target.close()
+            elif target in CAPTURES:
+                CAPTURES.close(target)
+            if n in saved:
+                self.fd_objs[n] = saved[n]
+            else:
+                self.fd_objs.pop(n, None)
+
+    def _line_sinks(self, on_stdout=None, on_stderr=None, batch_lines=100,
+                    batch_ms=50):
+        """
+        Return _LineSink's for the streams with a callback, by Popen
+        keyword argument.
+        """
+        followed = [(n, name, callback)
+                    for n, name, callback in ((STDOUT, 'stdout', on_stdout),
+                                              (STDERR, 'stderr', on_stderr))
+                    if callback is not None]
+        for n, name, callback in followed:
+            if not _is_fileno(n, self.fd_objs[n]):
+                raise ValueError(
+                    "cannot follow the child's %d stream: it was redirected"
+                    " to %r" % (n, _name_or_self(self.fd_objs[n])))
+        return dict((name, _LineSink(callback, batch_lines, batch_ms))
+                    for n, name, callback in followed)
+
+    def _wait_followed(self):
+        """
+        Wait until the callbacks have been given all the output, and
+        raise the first exception of a callback, if any.
+        """
+        for sink in getattr(self, '_followed', ()):
+            while not sink.done.is_set():
+                ## a timeout keeps us responsive to KeyboardInterrupt
+                sink.done.wait(0.1)
+        for sink in getattr(self, '_followed', ()):
+            if sink.error is not None:
+                error, sink.error = sink.error, None
+                raise error[0], error[1], error[2]
+
+    def _start_timeout(self, timeout=None, kill_timeout=0, **kwargs):
+        """
+        Return a started timer that kills the job if it still runs after
+        'timeout' seconds, or None without a timeout.  With a
+        'kill_timeout', the job is sent SIGTERM first and gets that many
+        more seconds to exit.
+        """
+        if not timeout:
+            return None
+        timer = threading.Timer(timeout, self._expire, (kill_timeout,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _expire(self, kill_timeout):
+        if kill_timeout:
+            self.kill(signal.SIGTERM)
+            time.sleep(kill_timeout)
+        self.kill()
+
+    def _drain_captures(self, fd):
+        """
+        Drain the bounded or compressed captures among streams 'fd',
+        replacing them in fd_objs by files of the captured output.
+
+        Return the dropped byte counts of the bounded streams.
+        """
+        sinks = [self.fd_objs[n] for n in fd
+                 if isinstance(self.fd_objs[n], _CaptureSink)]
+        if not sinks:
+            return {}
+        _drain(sinks)
+        dropped = {}
+        for n in fd:
+            if isinstance(self.fd_objs[n], _CaptureSink):
+                if hasattr(self.fd_objs[n], 'dropped'):
+                    dropped[n] = self.fd_objs[n].dropped
+                self.fd_objs[n] = CAPTURES.add(self.fd_objs[n].getfile())
+        return dropped
+
     def _cleanup_capture_dict(self, fd, fd_dict):
         if fd == STDOUT:
             target = STDERR
@@ -106,15 +1230,39 @@ class Process(object):
         Fork-exec the Cmd and wait for its termination, capturing the
         output and/or error.
 
-        :param fd: a list of file descriptors to capture,
-                   should be a subset of [1, 2] where
+        :param fd: a list of file descriptors to capture, where
           * 1 represents the child's stdout
           * 2 represents the child's stderr
+          * 3 and above are opened in the child on a capture of their
+            own, e.g. for progress reports next to the data on stdout
+
+        :param limit: if given, keep at most 'limit' bytes of each
+                      captured stream, chosen by 'keep'.  The rest is
+                      discarded as the child writes it, and counted in
+                      the 'dropped' dict of the result.
+
+        :param keep: 'head' for the first bytes, 'tail' (the default) for
+                     the last bytes, or 'both' for half of each.
+
+        :param timeout: if given, kill the child (its whole process group
+                        with pgroup=True) if it still runs after that many
+                        seconds.
+
+        :param kill_timeout: with a 'timeout', send SIGTERM first and give
+                        the child that many more seconds before SIGKILL.
+
+        :param compress: 'zlib', 'gzip' or 'lzma' (needs backports.lzma
+                     on Python 2) to compress the captured streams as the
+                     child writes them.  They are then read through file
+                     objects that decompress lazily, whose 'stats' dict
+                     holds the compression ratio and throughput.
 
         Return a namedtuple (stdout, stderr, exit_status) where
-        stdout and stderr are captured file objects or None.
+        stdout and stderr are captured file objects or None, and the
+        captured fds >= 3 are files in its 'fds' dict.
 
-        Don't forget to close the file objects!
+        Close the Capture, or use it in a with statement, to release the
+        files as soon as they are read.  See also CAPTURES.
 
        >>> Cmd("/bin/sh -c 'echo -n foo'").capture(1).stdout.read()
        'foo'
@@ -122,37 +1270,40 @@ class Process(object):
        >>> Cmd("/bin/sh -c 'echo -n bar >&2'").capture(2).stderr.read()
        'bar'
 
+       >>> Cmd("/bin/sh -c 'echo -n 50% >&3'").capture(3).fds[3].read()
+       '50%'
+
        """
         if len(fd) == 0:
             fd = [1]
-        for stream_num in fd:
-            fd_update_dict = self._verify_capture_args(stream_num, self.fd_objs)
-            self.fd_objs.update(fd_update_dict)
+        saved = dict(self.fd_objs)
+        try:
+            for stream_num in fd:
+                fd_update_dict = self._verify_capture_args(
+                    stream_num, self.fd_objs, **kwargs)
+                self.fd_objs.update(fd_update_dict)
 
-        proc_objs = [0]
-        def runit():
-            proc_objs[0] = self._popen()
-        if kwargs.get('timeout'):
-            timeout =  kwargs.get('timeout')
-            proc_thread = threading.Thread(target=runit)
-            proc_thread.start()
-            proc_thread.join(timeout)
-            kill_timeout = kwargs.get('kill_timeout', 0)
-            time.sleep(kill_timeout)
-            self.kill()
-        else:
-            runit()
-        p = proc_objs[0]
+            p = self._popen()
+        except:
+            self._abort_capture(fd, saved)
+            raise
+        timer = self._start_timeout(**kwargs)
 
         if p.fd_objs[STDIN]:
             p.fd_objs[STDIN].close()
+        dropped = self._drain_captures(fd)
         p.wait()
+        self._wait_substitutions()
+        if timer:
+            timer.cancel()
         if not set(fd) == set([1,2]):
              self._cleanup_capture_dict(fd[0], p.fd_objs)
         for stream_number in fd:
             self.fd_objs[stream_number].seek(0)
         self.kill()
-        return Capture(self.fd_objs[1], self.fd_objs[2], p.returncode)
+        return Capture(self.fd_objs[1], self.fd_objs[2], p.returncode,
+                       getattr(p, 'result', None), dropped,
+                       dict((n, self.fd_objs[n]) for n in fd if n > 2))
 
     def _process_fd_pair(self, stream_num, fd_descriptor):
         """for now this just does error checking
@@ -161,33 +1312,55 @@ class Process(object):
         """
         if not isinstance(stream_num, int):
             raise TypeError("fd keys must have type int")
-        elif stream_num < 0 or stream_num >= 3:
-             raise NotImplementedError(
-                "redirection {%s: %s} not supported" % (
-                     stream_num, fd_descriptor))
+        elif stream_num < 0:
+            raise ValueError("fd keys must be >= 0, not %d" % stream_num)
+        if fd_descriptor is CLOSE:
+            return CLOSE
         if isinstance(fd_descriptor, basestring):
             new_fd = open(fd_descriptor, 'r' if stream_num == 0 else 'w')
             return new_fd
         elif isinstance(fd_descriptor, int):
             if stream_num == 2 and fd_descriptor == 1:
                 return _ORIG_STDOUT
-            elif (fd_descriptor in (0, 1, 2)):
-                raise NotImplementedError(
-                    "redirection {%s: %s} not supported"
-                     % (stream_num, fd_descriptor))
+            elif stream_num > 2 and fd_descriptor < 0:
+                raise ValueError(
+                    "redirection {%s: %s} not supported, capture(%s) reads"
+                    " the child's fd %s" % (stream_num, fd_descriptor,
+                                           stream_num, stream_num))
             return fd_descriptor
         elif isinstance(fd_descriptor, file):
             return fd_descriptor
         else:
             assert 1==2, "fd_descriptors must be a string\
                           stream number or file"
+    def _redirect_args(self):
+        """
+        Return the stdin, stdout, stderr and fd_map Popen arguments of
+        the redirections in fd_objs.  The redirections of fds >= 3, to
+        CLOSE, or of a standard stream to another one, are done in the
+        child by the fd_map once its stdin, stdout and stderr are set up.
+        """
+        fd_map = {}
+        for n, target in self.fd_objs.iteritems():
+            if n > 2 or target is CLOSE or (
+                    isinstance(target, int) and target in (0, 1, 2)
+                    and target != n):
+                if target is CLOSE or isinstance(target, int):
+                    fd_map[n] = target
+                else:
+                    fd_map[n] = target.fileno()
+        args = dict(fd_map=fd_map)
+        for n, name in enumerate(('stdin', 'stdout', 'stderr')):
+            args[name] = None if n in fd_map else self.fd_objs[n]
+        return args
+
     @property
     def popen_args(self):
         return dict(
-            args=self.cmd, cwd=self.cd, env=self.env,
-            stdin=self.fd_objs[0],
-            stdout=self.fd_objs[1],
-            stderr=self.fd_objs[2])
+            args=self.cmd, executable=self.executable, cwd=self.cd,
+            env=self.env,
+            close_fds=True, keep_fds=self.keep_fds,
+            pgid=0 if self.pgroup else None, **self._redirect_args())
 
     def pipe_to(self, cmd_obj):
         return Pipe(self, cmd_obj)
@@ -199,6 +1372,7 @@ class Cmd(Process):
 
     def _make_cmd(self, cmd_arg):
         if isinstance(cmd_arg, basestring):
+            import shlex
             self.cmd = shlex.split(cmd_arg)
         elif isinstance(cmd_arg, (list, tuple)):
             self.cmd = cmd_arg
@@ -211,7 +1385,8 @@ class Cmd(Process):
     objects, or number flags
 
     """
-    def __init__(self, cmd, fd={}, e={}, cd=None, stdin_data=None):
+    def __init__(self, cmd, fd={}, e={}, cd=None, stdin_data=None,
+                 keep_fds=(), pgroup=False):
         """
         Prepare for a fork-exec of 'cmd' with information about changing
         of working directory, extra environment variables and I/O
@@ -222,24 +1397,40 @@ class Cmd(Process):
 
         :param e: a dict of *extra* enviroment variables.
 
-        :param fd: a dict mapping k in [0, 1, 2] → v of type [file, string, int]
+        :param fd: a dict mapping k ≥ 0 → v of type [file, string, int]
+            or CLOSE
 
           Whatever is pointed to by fd[0], fd[1] and fd[2] will become the
-          child's stdin, stdout and stderr, respectively.
+          child's stdin, stdout and stderr, respectively, and fd[k] its
+          fd k for k ≥ 3.
 
           If any of key [0, 1, 2] is not specified, then it takes the
           values [0, 1, 2] respectively -- in effect, reusing the parent's
-          [stdin, stdout, stderr].
+          [stdin, stdout, stderr].  Other fds are closed, see 'keep_fds'.
 
           The value fd[k] can be of type
           * file: always works and offer the most control over mode of operation
           * string: works if can be open()'ed with mode 'r' when k == 0,
-            or mode 'w' for k in [1, 2]
-         * int: works for redirection {2: 1}
-                or {k: v} when v ≥ 3 and v is an existing file descriptor
+            or mode 'w' for other k
+          * int: the child's stream v in [0, 1, 2] once redirected, as
+                 {2: 1} or {1: 2} (2>&1, 1>&2), or an existing file
+                 descriptor v ≥ 3 of the parent, e.g. {3: 3} to pass it
+                 through
+          * CLOSE: the fd is closed in the child before exec
+
+        :param keep_fds: file descriptors >= 3 to be inherited by the child.
+            All other fds >= 3 are closed in the child before exec, so that
+            it does not hold open the pipes and capture files of other jobs.
+
+        :param pgroup: if True, run the child in a new process group, so
+            that kill() and capture timeouts signal everything it forked
+            too, with a single killpg.  See also subreaper().
 
         Note that the constructor only saves information in the object and
-        does not actually execute anything.
+        does not actually execute anything, except looking up cmd[0] in
+        the PATH through EXECUTABLES: an OSError is raised here if it
+        cannot be found.  It is looked up again when the Cmd is spawned
+        if a Pipe or chain has changed its PATH since.
 
         >>> Cmd("/bin/sh -c 'echo foo'")
         Cmd(['/bin/sh', '-c', 'echo foo'], fd={0: 0, 1: 1, 2: 2}, e={}, cd=None)
@@ -250,12 +1441,16 @@ class Cmd(Process):
 
         self._make_cmd(cmd)
         self.cd = cd
+        self.keep_fds = frozenset(keep_fds)
+        self.pgroup = pgroup
         self.env = os.environ.copy()
         if e:
             self.e = e
             self.env.update(self.e)
         else:
             self.e = {}
+        self._resolved = None
+        self._resolve()
 
         self.fd_objs = DEFAULT_FD.copy()
         self.fd_objs.update(fd)
@@ -266,7 +1461,6 @@ class Cmd(Process):
                     "Can't specify a file for STDIN and stdin_data ")
             #tf_file_path = tempfile.mktemp()
             #self.tf = open(tf_file_path, "w")
-            #pdb.set_trace()
             #self.tf.write(stdin_data)
             #self.fd_objs.update({STDIN:open(tf_file_path)})
 
@@ -283,11 +1477,54 @@ class Cmd(Process):
         return (self.cmd == other.cmd) and (self.fd_objs == other.fd_objs) and\
                (self.env == other.env) and (self.cd == other.cd)
 
-    def kill(self):
+    def _clone(self):
+        """
+        Return an unspawned copy of the Cmd: every attribute __init__
+        sets, with fresh containers so that the copies never share state.
+        """
+        c = type(self).__new__(type(self))
+        c.cmd = list(self.cmd)
+        c.cd = self.cd
+        c.keep_fds = self.keep_fds
+        c.pgroup = self.pgroup
+        c.env = self.env.copy()
+        c.e = self.e.copy()
+        c.fd_objs = self.fd_objs.copy()
+        c.stdin_data = self.stdin_data
+        c._resolved = self._resolved
+        return c
+
+    @property
+    def executable(self):
+        """
+        The full path of cmd[0] in the PATH of the child.
+        """
+        return self._resolve()
+
+    def _resolve(self):
+        """
+        Look up cmd[0] through EXECUTABLES, unless it was already for the
+        current PATH.
+        """
+        if not self.cmd:
+            return None
+        path = self.env.get('PATH', os.defpath)
+        if self._resolved is None or self._resolved[0] != path:
+            self._resolved = (path, EXECUTABLES.resolve(
+                self.cmd[0], path, self.cd))
+        return self._resolved[1]
+
+    def kill(self, sig=signal.SIGKILL):
         if not getattr(self, 'p', False):
             raise Exception('No process to kill')
+        pgid = self.pgroup and getattr(self.p, 'pgid', None)
         try:
-            return self.p.kill()
+            if pgid:
+                ## even if the child itself has exited, to get its orphans
+                _killpg(pgid, sig)
+                _reap_orphans(pgid, [self.p.pid], sig == signal.SIGKILL)
+            elif self.p.returncode is None:
+                return self.p.send_signal(sig)
         except OSError:
             pass
         finally:
@@ -299,7 +1536,10 @@ class Cmd(Process):
         if not getattr(self, 'p', False):
             raise Exception('No process to kill')
         try:
-            return self.p.wait()
+            returncode = self.p.wait()
+            self._wait_followed()
+            self._wait_substitutions()
+            return returncode
         finally:
             for job in JOBS:
                 if job is self:
@@ -317,17 +1557,36 @@ class Cmd(Process):
         >>> Cmd(['/bin/sh', '-c', 'exit 1']).run()
         1
         """
-        return subprocess.call(**self.popen_args)
+        returncode = self._new_popen(self.popen_args).wait()
+        self._wait_substitutions()
+        return returncode
 
-    def spawn(self, append_to_jobs=True):
+    def spawn(self, append_to_jobs=True, **follow):
         """
         Fork-exec the Cmd but do not wait for its termination.
 
+        :param on_stdout, on_stderr: callables to be given the lines that
+            the child writes to its stdout or stderr as they come, in
+            batches of at most 'batch_lines' (100) lines, or of whatever
+            came in 'batch_ms' (50) milliseconds, as lists of strings
+            without their newline.  They are called from a single thread
+            that follows the output of all jobs.  wait() returns once
+            they have been given all the output, and raises the exception
+            of a callback that failed, after which it got no more lines.
+
         Return a subprocess.Popen object (which is also stored in 'self.p')
         """
         if getattr(self, 'p', False):
             raise Exception('can only spawn once per cmd object')
-        self._popen()
+        sinks = self._line_sinks(**follow)
+        try:
+            self._popen(**sinks)
+        except:
+            for sink in sinks.values():
+                sink.close()
+            raise
+        self._followed = sinks.values()
+        _follow(self._followed)
         if append_to_jobs:
             JOBS.append(self)
         return self.p
@@ -341,10 +1600,83 @@ class Cmd(Process):
         self.p.poll()
         return self.p.returncode
 
+    def _popen_class(self):
+        import py_popen
+        return py_popen.ExtPopen
+
+    def _new_popen(self, popen_args):
+        popen_args, pipe_fds = self._spawn_substitutions(popen_args)
+        try:
+            return self._new_popen_traced(popen_args)
+        except:
+            for arg in self._substitutions:
+                arg.kill()
+            raise
+        finally:
+            for fd in pipe_fds:
+                os.close(fd)
+
+    def _spawn_substitutions(self, popen_args):
+        """
+        Spawn the jobs of the In and Out arguments, and replace them by
+        the /dev/fd paths of pipes to them, kept open for the child.
+
+        Return the popen arguments, and the fds of the pipes for the
+        parent to close once the child is spawned.
+        """
+        self._substitutions = [arg for arg in popen_args.get('args', ())
+                               if isinstance(arg, _Substitution)]
+        if not self._substitutions:
+            return popen_args, []
+        args = list(popen_args['args'])
+        keep_fds = set(popen_args.get('keep_fds', ()))
+        pipe_fds = []
+        spawned = []
+        try:
+            for i, arg in enumerate(args):
+                if isinstance(arg, _Substitution):
+                    read_fd, write_fd = os.pipe()
+                    pipe_fds.extend([read_fd, write_fd])
+                    fd = arg._spawn(read_fd, write_fd)
+                    spawned.append(arg)
+                    keep_fds.add(fd)
+                    args[i] = '/dev/fd/%d' % fd
+        except:
+            for fd in pipe_fds:
+                os.close(fd)
+            for arg in spawned:
+                arg.kill()
+            raise
+        popen_args = dict(popen_args, args=args, keep_fds=frozenset(keep_fds))
+        return popen_args, pipe_fds
+
+    def _wait_substitutions(self):
+        for arg in getattr(self, '_substitutions', ()):
+            arg.wait()
+
+    def _new_popen_traced(self, popen_args):
+        ## every child reads a here() file from the start
+        if CAPTURES.is_here(popen_args.get('stdin')):
+            popen_args['stdin'].seek(0)
+        tracer = _TRACER
+        if tracer is None:
+            p = self._popen_class()(**popen_args)
+        else:
+            forked = time.time()
+            p = self._popen_class()(**popen_args)
+            tracer.spawned(self, p, forked, popen_args)
+        return p
+
     def _popen(self, **kwargs):
         basic_popen_args = self.popen_args
         basic_popen_args.update(kwargs)
-        ab = subprocess.Popen(**basic_popen_args)
+        if basic_popen_args.get('fd_map'):
+            ## a stream given by the caller replaces that of the fd_map
+            basic_popen_args['fd_map'] = dict(
+                (n, fd) for n, fd in basic_popen_args['fd_map'].iteritems()
+                if n > 2 or kwargs.get(('stdin', 'stdout', 'stderr')[n])
+                is None)
+        ab = self._new_popen(basic_popen_args)
         self.p = decorate_popen(ab)
         return self.p
 
@@ -356,13 +1688,14 @@ def decorate_popen(popen_obj):
     return popen_obj
 
 class Sh(Cmd):
-  def __init__(self, cmd, fd={}, e={}, cd=None):
+  def __init__(self, cmd, fd={}, e={}, cd=None, keep_fds=(), pgroup=False):
     """
     Prepare for a fork-exec of a shell command.
 
     Equivalent to Cmd(['/bin/sh', '-c', cmd], **kwargs).
     """
-    super(Sh, self).__init__(['/bin/sh', '-c', cmd], fd=fd, e=e, cd=cd)
+    super(Sh, self).__init__(['/bin/sh', '-c', cmd], fd=fd, e=e, cd=cd,
+                             keep_fds=keep_fds, pgroup=pgroup)
 
   def __repr__(self):
     return "Sh(%r, fd=%r, e=%r, cd=%r)" % (self.cmd[2], dict(
@@ -370,37 +1703,262 @@ class Sh(Cmd):
         ), self.e, self.cd)
 
 
-class LiveCapture(object):
-    def __init__(self, pipe_obj):
-        self.pipe_obj = pipe_obj
+class _Substitution(object):
+    def __init__(self, job):
+        if isinstance(job, basestring):
+            job = Cmd(job)
+        n = self.job_stream
+        if not _is_fileno(n, job.fd_objs[n]):
+            raise ValueError(
+                "cannot substitute the %d stream of %r: it was redirected to"
+                " %r" % (n, job, _name_or_self(job.fd_objs[n])))
+        self.job = job
 
-    @property
-    def stdout(self):
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.job)
 
-        if self.returncode is not None:
-            self.pipe_obj.fd_objs[STDOUT].seek(0)
-            return self.pipe_obj.fd_objs[STDOUT].read()
+    def __str__(self):
+        return "%s(%s)" % (self.sigil, _job_name(self.job))
 
-    @property
-    def stderr(self):
-        if self.returncode is not None:
-            self.pipe_obj.fd_objs[STDERR].seek(0)
-            return self.pipe_obj.fd_objs[STDERR].read()
+    def _spawn(self, read_fd, write_fd):
+        """
+        Spawn the job on its end of the pipe (read_fd, write_fd), and
+        return the other end, for the command.
+        """
+        job_fd, cmd_fd = ((write_fd, read_fd) if self.job_stream == STDOUT
+                          else (read_fd, write_fd))
+        self.job._popen(**{('stdin', 'stdout')[self.job_stream]: job_fd})
+        if isinstance(self.job, Pipe):
+            self.job.close_links()
+        return cmd_fd
+
+    def kill(self):
+        """
+        Kill the job and wait for it, when the command could not be
+        spawned.
+        """
+        self.job.kill()
+        self.wait()
+
+    def wait(self):
+        """
+        Wait for the job and return its exit status.
+        """
+        if isinstance(self.job, Pipe):
+            for c in self.job.cmds:
+                c.wait()
+            self.job._stop_monitor()
+        return self.job.wait()
 
     @property
     def returncode(self):
-        return self.pipe_obj.returncode
+        return self.job.returncode
+
+class In(_Substitution):
+    """
+    Process substitution <(job): an argument of a Cmd that becomes the
+    path /dev/fd/N of a pipe from the stdout of 'job', a Cmd or Pipe
+    spawned along with the command, e.g.
 
+    >>> Cmd(['comm', '-3', In('seq 1 4'), In('seq 2 5')]).capture().stdout.read()
+    '1\\n\\t5\\n'
 
+    The jobs of the substitutions are waited for with the command.
+    """
+    job_stream = STDOUT
+    sigil = '<'
 
+class Out(_Substitution):
+    """
+    Process substitution >(job): an argument of a Cmd that becomes the
+    path /dev/fd/N of a pipe to the stdin of 'job', e.g.
 
-class Pipe(Process):
-    def __init__(self, *cmds, **kwargs):
+    >>> Cmd(['cp', '/etc/passwd', Out(Cmd('wc -c', {STDOUT: os.devnull}))]).run()
+    0
+    """
+    job_stream = STDIN
+    sigil = '>'
+
+
+class CmdTemplate(object):
+    def __init__(self, cmd, fd={}, e={}, cd=None, keep_fds=()):
         """
-        Prepare a pipeline from a list of Cmd's.
+        Prepare a command shape to be spawned many times with different
+        arguments, e.g.
 
-        :parameter e: extra environment variables to be exported to all
-                      sub-commands, must be a keyword argument
+        >>> copy = CmdTemplate('cp -p {src} {dst}.bak')
+        >>> copy(src='in.png', dst='my out.png').cmd
+        ['cp', '-p', 'in.png', 'my out.png.bak']
+
+        'cmd' is split, and the executable looked up, only once.  Calling
+        the template substitutes the {name} fields of each argument
+        separately, so a value always stays within its argument whatever
+        spaces, quotes or shell metacharacters it contains.  The command
+        itself, cmd[0], cannot be a field.
+
+        The other parameters are those of Cmd.  String values of 'fd' are
+        opened anew for every Cmd.
+        """
+        import string
+        if isinstance(cmd, basestring):
+            import shlex
+            cmd = shlex.split(cmd)
+        self.fields = set()
+        self.args = []
+        for i, arg in enumerate(cmd):
+            names = [name for _, name, _, _ in string.Formatter().parse(arg)
+                     if name is not None]
+            for name in names:
+                if not (name and _is_identifier(name)):
+                    raise ValueError(
+                        "template fields must be plain names, got {%s}"
+                        % (name,))
+            if names and i == 0:
+                raise ValueError("the command cannot be a template field")
+            self.fields.update(names)
+            self.args.append((arg, bool(names)))
+
+        self.fd_paths = dict(
+            (k, v) for k, v in fd.iteritems() if isinstance(v, basestring))
+        self.prototype = Cmd(
+            [arg for arg, _ in self.args], e=e, cd=cd, keep_fds=keep_fds,
+            fd=dict((k, v) for k, v in fd.iteritems()
+                    if k not in self.fd_paths))
+
+    def __repr__(self):
+        return "CmdTemplate(%r, fd=%r, e=%r, cd=%r)" % (
+            [arg for arg, _ in self.args],
+            dict((k, _name_or_self(v))
+                 for k, v in self.prototype.fd_objs.iteritems()),
+            self.prototype.e, self.prototype.cd)
+
+    def __call__(self, **values):
+        """
+        Return a new Cmd with the fields substituted by 'values'.
+        """
+        if set(values) != self.fields:
+            raise TypeError(
+                "template fields %s expected, got %s"
+                % (sorted(self.fields), sorted(values)))
+        c = self.prototype._clone()
+        c.cmd = [arg.format(**values) if is_template else arg
+                 for arg, is_template in self.args]
+        for stream_num, path in self.fd_paths.iteritems():
+            c.fd_objs[stream_num] = c._process_fd_pair(stream_num, path)
+        return c
+
+    def spawn(self, **values):
+        """
+        Fork-exec a new Cmd from the template but do not wait for its
+        termination.  Return the Cmd.
+        """
+        c = self(**values)
+        c.spawn()
+        return c
+
+def _is_identifier(name):
+    return name.replace('_', 'a').isalnum() and not name[0].isdigit()
+
+
+class LiveCapture(object):
+    """
+    The capture of a spawned Pipe, see Pipe.capture_spawn().  Use it as
+    a context manager, or close() it, to release its files.
+    """
+    def __init__(self, pipe_obj):
+        self.pipe_obj = pipe_obj
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Kill the pipeline if it still runs, and close the captured files.
+        """
+        if self.returncode is None:
+            self.pipe_obj.kill()
+            self.pipe_obj.wait()
+        self._drained()
+        CAPTURES.close(*self.pipe_obj.fd_objs.values())
+
+    def _drained(self):
+        drainer = getattr(self.pipe_obj, '_drainer', None)
+        if drainer is not None:
+            drainer.join()
+
+    @property
+    def stdout(self):
+
+        if self.returncode is not None:
+            self._drained()
+            self.pipe_obj.fd_objs[STDOUT].seek(0)
+            return self.pipe_obj.fd_objs[STDOUT].read()
+
+    @property
+    def stderr(self):
+        if self.returncode is not None:
+            self._drained()
+            self.pipe_obj.fd_objs[STDERR].seek(0)
+            return self.pipe_obj.fd_objs[STDERR].read()
+
+    @property
+    def returncode(self):
+        return self.pipe_obj.returncode
+
+
+
+
+class Pipe(Process):
+    def __init__(self, *cmds, **kwargs):
+        """
+        Prepare a pipeline from a list of Cmd's.
+
+        :parameter e: extra environment variables to be exported to all
+                      sub-commands, must be a keyword argument
+
+        :parameter keep_fds: fds >= 3 to be inherited by all sub-commands,
+                      must be a keyword argument
+
+        :parameter fuse: if True, run each series of consecutive
+                      object-mode PythonProc's in a single forked child
+                      that chains their functions as generators, must be
+                      a keyword argument.  'cmds' then holds the fused
+                      stages, while 'returncodes' still has one entry
+                      per original stage: the stages fused together all
+                      have the exit status of the child they share.
+                      Stages with pgroup=True or redirections of fds >= 3
+                      are never fused.
+
+        :parameter pipe_size: the capacity in bytes of the pipes between
+                      stages, must be a keyword argument.  Either one value
+                      for all links or a list with one value per link
+                      between the stages given, before any 'fuse' (the
+                      links within a fused series then go unused).  A
+                      value may be None for the system default (64 KiB
+                      on Linux), a number of bytes, or 'auto' to start
+                      with the default and double the capacity whenever
+                      the link is found full, i.e. its reader is slower
+                      than its writer.
+                      Sizes are capped by /proc/sys/fs/pipe-max-size.
+
+        :parameter monitor: if True (or a sampling interval in seconds,
+                      0.01 by default), sample the running pipeline from a
+                      background thread, see metrics(), must be a keyword
+                      argument.
+
+        :parameter on_metrics: a callable to be given a metrics() snapshot
+                      every 'metrics_interval' seconds (1 by default) while
+                      the pipeline runs, from the monitor thread; implies
+                      'monitor', must be a keyword argument.
+
+        :parameter pgroup: if True, run all the stages in one new process
+                      group, so that kill() and capture timeouts signal
+                      the whole pipeline and everything it forked with a
+                      single killpg, must be a keyword argument.  'pgid'
+                      is then the id of the group once spawned.
         """
         self.env = os.environ.copy()
         e = kwargs.get('e', {})
@@ -409,12 +1967,50 @@ class Pipe(Process):
             self.env.update(self.e)
         else:
             self.e = {}
+        self.keep_fds = frozenset(kwargs.get('keep_fds', ()))
         for c in cmds:
             c.e.update(self.e)
             c.env.update(self.e)
+            c.keep_fds = c.keep_fds.union(self.keep_fds)
         for c in cmds[:-1]:
             if _is_fileno(1, c.fd_objs[STDOUT]):
               c.fd_objs[STDOUT] = PIPE
+        pipe_size = kwargs.get('pipe_size')
+        if isinstance(pipe_size, (list, tuple)):
+            if len(pipe_size) != len(cmds) - 1:
+                raise ValueError(
+                    "pipe_size must have one value per link, i.e. %d"
+                    % (len(cmds) - 1,))
+            pipe_size = list(pipe_size)
+        if kwargs.get('fuse'):
+            cmds = _fuse_stages(cmds)
+        for c in cmds:
+            ## weak: a cycle would keep the links open until collected
+            c.parent = weakref.ref(self)
+        ## adjacent object-mode PythonProc's exchange framed batches
+        for a, b in zip(cmds[:-1], cmds[1:]):
+            if _object_link(a, b):
+                a.framed_out = True
+                b.framed_in = a.codec
+
+        if isinstance(pipe_size, list):
+            ## the size of each link left by fusion, out of the last
+            ## stage of a fused series
+            ends = []
+            for c in cmds:
+                ends.append((ends[-1] if ends else -1) +
+                            len(getattr(c, 'members', [c])))
+            self.pipe_sizes = [pipe_size[end] for end in ends[:-1]]
+        else:
+            self.pipe_sizes = [pipe_size] * (len(cmds) - 1)
+        self.monitor = kwargs.get('monitor', False)
+        self.on_metrics = kwargs.get('on_metrics')
+        self.metrics_interval = kwargs.get('metrics_interval', 1.0)
+        self._monitor = None
+        ## held to close a link, and by the monitor while it samples one
+        self._links_lock = threading.RLock()
+        self.pgroup = kwargs.get('pgroup', False)
+        self.pgid = None
 
         self.fd_objs = {STDIN: cmds[0].fd_objs[STDIN],
                         STDOUT: cmds[-1].fd_objs[STDOUT],
@@ -422,6 +2018,7 @@ class Pipe(Process):
 
         self.cmds = cmds
         self.cmd = "PIPE, not a real command"
+        self.executable = None
         self.cd = self.cmds[0].cd
 
     def __repr__(self):
@@ -433,17 +2030,110 @@ class Pipe(Process):
 
         Return an array of all children's exit status.
         """
-        prev = self.cmds[0].fd_objs[STDIN]
-        for c in self.cmds:
-            c._popen(stdin=prev)
-            prev = c.running_fd_objs[STDOUT]
+        return self._run()
+
+    def _run(self, **redirect):
+        """
+        Run the pipeline with its stdin, stdout and stderr replaced by
+        those in 'redirect' (Popen keyword arguments), except in stages
+        that redirected them themselves.
+        """
+        prev = redirect.get('stdin', self.cmds[0].fd_objs[STDIN])
+        for i, c in enumerate(self.cmds):
+            kwargs = dict(stdin=prev)
+            if 'stderr' in redirect and _is_fileno(STDERR, c.fd_objs[STDERR]):
+                kwargs['stderr'] = redirect['stderr']
+            if i < len(self.cmds) - 1:
+                self._popen_stage(c, **kwargs)
+                prev = self._link(i)
+            else:
+                if 'stdout' in redirect:
+                    kwargs['stdout'] = redirect['stdout']
+                self._popen_stage(c, **kwargs)
+        self._start_monitor()
+        self.close_links()
         for c in self.cmds:
             c.wait()
-        for c in self.cmds[:-1]:
+        self._stop_monitor()
+        self._close_links()
+
+        return self.returncode
+
+    def _link(self, i):
+        """
+        Prepare the pipe out of the freshly spawned self.cmds[i] and
+        return it.
+        """
+        f = self.cmds[i].running_fd_objs[STDOUT]
+        size = self.pipe_sizes[i]
+        if f is not None and size and size != 'auto':
+            _set_pipe_size(f, size)
+        return f
+
+    def close_links(self):
+        """
+        Close our copies of the links between the stages of the spawned
+        pipeline, so that a stage whose reader died gets EPIPE instead of
+        blocking.  A monitored pipeline keeps them for the monitor, which
+        closes the link of a dead reader itself.
+        """
+        if self._monitor is None:
+            self._close_links()
+
+    def _close_links(self):
+        for i in range(len(self.cmds) - 1):
+            self._close_link(i)
+
+    def _close_link(self, i):
+        """
+        Close our copy of the link out of self.cmds[i], the only place
+        where links are closed.
+        """
+        c = self.cmds[i]
+        with self._links_lock:
             if c.fd_objs[STDOUT] == PIPE:
                 c.running_fd_objs[STDOUT].close()
 
-        return self.returncode
+    def _start_monitor(self):
+        if 'auto' in self.pipe_sizes or self.monitor or self.on_metrics:
+            interval = self.monitor
+            if interval is True or not interval:
+                interval = 0.01
+            self._monitor = _PipeMonitor(
+                self, interval, self.on_metrics, self.metrics_interval)
+            self._monitor.start()
+
+    def _stop_monitor(self):
+        ## before any link gets closed, so that the monitor never touches
+        ## a reused fd
+        if self._monitor is not None:
+            self._monitor.stop()
+
+    def metrics(self):
+        """
+        Return a snapshot of the pipeline measured by the monitor, or None
+        if the Pipe is not monitored or has not been spawned.
+
+        The snapshot is a dict with keys:
+
+          * 'elapsed': seconds from the spawn of the pipeline to the last
+            sample
+          * 'links': for each link, a dict with the bytes 'written' so
+            far by the stage feeding it, to the link and to any other file
+            (wchar in /proc/<pid>/io), their 'rate' in bytes/s over the
+            last metrics interval, and the bytes 'queued' in the pipe and
+            its 'capacity' at the last sample
+          * 'stages': for each stage, a dict with its 'pid' and the seconds
+            it was found 'blocked_read' on an empty input link or
+            'blocked_write' on a full output link
+
+        Blocked times are estimated by sampling: a stage is counted as
+        blocked for a whole interval whenever a sample finds its link
+        empty or full.
+        """
+        if self._monitor is None:
+            return None
+        return self._monitor.snapshot()
 
     @property
     def returncode(self):
@@ -454,7 +2144,18 @@ class Pipe(Process):
 
     @property
     def returncodes(self):
-        return [c.returncode for c in self.cmds]
+        returncodes = []
+        for c in self.cmds:
+            returncodes.extend(
+                [c.returncode] * len(getattr(c, 'members', [c])))
+        return returncodes
+
+    @property
+    def result(self):
+        """
+        The return value of the last stage if it is a PythonProc.
+        """
+        return getattr(self.cmds[-1], 'result', None)
 
     @property
     def running_fd_objs(self):
@@ -462,46 +2163,120 @@ class Pipe(Process):
                 STDOUT:self.cmds[-1].running_fd_objs[STDOUT],
                 STDERR:self.cmds[-1].running_fd_objs[STDERR]}
 
-    def spawn(self):
+    def spawn(self, **follow):
         """
         Fork-exec the pipeline but do not wait for its termination.
 
         After spawned, each self.cmd[i] will have a 'p' attribute that is
         the spawned subprocess.Popen object.
 
-        Remember that all of [c.p.stdout for c in self.cmd] are open files.
+        Remember that all of [c.p.stdout for c in self.cmd] are open files,
+        until close_links() is called.
+
+        The keyword arguments 'on_stdout', 'on_stderr', 'batch_lines' and
+        'batch_ms' are those of Cmd.spawn, for the stdout of the last
+        stage and the stderr of all stages.
        """
         if getattr(self, 'p', False):
             raise Exception('you can only spawn a Cmd object once')
+        sinks = self._line_sinks(**follow)
 
-        prev = self.cmds[0].fd_objs[STDIN]
-        for c in self.cmds[:-1]:
-            c._popen(stdin=prev, stdout=PIPE)
-            prev = c.running_fd_objs[STDOUT]
-
-        basic_popen_args = self.popen_args
-
-        self.cmds[-1]._popen(
-            stdin=prev,
-            stdout=basic_popen_args['stdout'],
-            stderr=basic_popen_args['stderr'])
+        try:
+            prev = self.cmds[0].fd_objs[STDIN]
+            for i, c in enumerate(self.cmds[:-1]):
+                kwargs = {}
+                if ('stderr' in sinks and
+                    _is_fileno(STDERR, c.fd_objs[STDERR])):
+                    kwargs['stderr'] = sinks['stderr']
+                self._popen_stage(c, stdin=prev, stdout=PIPE, **kwargs)
+                prev = self._link(i)
+
+            basic_popen_args = self.popen_args
+            basic_popen_args.update(sinks)
+
+            self._popen_stage(
+                self.cmds[-1],
+                stdin=prev,
+                stdout=basic_popen_args['stdout'],
+                stderr=basic_popen_args['stderr'])
+        except:
+            self._abort_spawn()
+            for sink in sinks.values():
+                sink.close()
+            raise
+        self._start_monitor()
+        self._followed = sinks.values()
+        _follow(self._followed)
 
         JOBS.append(self)
         return self
 
-    def kill(self):
+    def kill(self, sig=signal.SIGKILL):
+        """
+        Send 'sig' to every stage.  With SIGKILL, also wait for them, so
+        that none is left a zombie and all their returncodes are set.
+        """
         try:
+            self._stop_monitor()
+            _killpg(self.pgid, sig)
             for c in self.cmds:
-                c.kill()
+                c.kill(sig)
+            _reap_orphans(self.pgid, self._pids(), sig == signal.SIGKILL)
+            if sig == signal.SIGKILL:
+                for c in self.cmds:
+                    if getattr(c, 'p', None):
+                        c.wait()
         finally:
             for job in JOBS:
                 if job is self:
                     JOBS.remove(self)
 
+    def _pids(self):
+        return [c.p.pid for c in self.cmds if getattr(c, 'p', None)]
+
+    def _teardown(self, grace=0.1):
+        """
+        Kill and wait for what is left of the pipeline once its last stage
+        has exited, after giving the other stages 'grace' seconds to exit
+        by themselves, as they normally do on EOF or EPIPE.
+        """
+        deadline = time.time() + grace
+        while (None in [c.returncode for c in self.cmds]
+               and time.time() < deadline):
+            time.sleep(0.005)
+        self.kill()
+
+    def _abort_spawn(self):
+        """
+        Kill and wait for the stages already spawned when another one
+        could not be, and close the links out of them.
+        """
+        for i, c in enumerate(self.cmds):
+            if not getattr(c, 'p', None):
+                continue
+            c.kill()
+            c.wait()
+            if i < len(self.cmds) - 1:
+                self._close_link(i)
+
+    def _popen_stage(self, c, **kwargs):
+        """
+        Spawn stage 'c', in the process group of the pipeline if any.
+        """
+        if self.pgroup:
+            kwargs['pgid'] = self.pgid or 0
+        p = c._popen(**kwargs)
+        if self.pgroup and not self.pgid:
+            self.pgid = getattr(p, 'pgid', None)
+        return p
+
     def wait(self, func=None):
         try:
-            return self.cmds[-1].wait()
+            returncode = self.cmds[-1].wait()
+            self._wait_followed()
+            return returncode
         finally:
+            self._stop_monitor()
             for job in JOBS:
                 if job is self:
                     JOBS.remove(self)
@@ -514,89 +2289,99 @@ class Pipe(Process):
         """
         if len(fd) == 0:
             fd = [1]
-        for descriptor in fd:
-            fd_update_dict = self._verify_capture_args(descriptor, self.fd_objs)
-            self.fd_objs.update(fd_update_dict)
-
-        if STDERR in fd:
-            self.fd_objs[STDERR] = tempfile.TemporaryFile()
+        saved = dict(self.fd_objs)
+        try:
+            for descriptor in fd:
+                fd_update_dict = self._verify_capture_args(
+                    descriptor, self.fd_objs, **kwargs)
+                self.fd_objs.update(fd_update_dict)
+        except:
+            self._abort_capture(fd, saved)
+            raise
 
         def runit():
+            try:
+                spawn()
+            except:
+                self._abort_spawn()
+                self._abort_capture(fd, saved)
+                raise
+        def spawn():
             ## start piping
 
             prev = self.cmds[0].fd_objs[0]
+            ## all the stages write to the capture of an fd >= 3
+            for c in self.cmds:
+                for n in fd:
+                    if n > 2 and n not in c.fd_objs:
+                        c.fd_objs[n] = self.fd_objs[n]
 
-            for c in self.cmds[:-1]:
+            for i, c in enumerate(self.cmds[:-1]):
                 if not _is_fileno(STDIN, c.fd_objs[STDIN]):
                     prev = c.fd_objs[STDIN]
                 if STDERR in fd and _is_fileno(STDERR, c.fd_objs[STDERR]):
                     c.fd_objs[STDERR] = self.fd_objs[STDERR]
-                c._popen(stdin=prev)
-                prev = c.running_fd_objs[STDOUT]
+                self._popen_stage(c, stdin=prev)
+                prev = self._link(i)
             ## prepare and fork the last child
             c = self.cmds[-1]
             if not _is_fileno(STDIN, c.fd_objs[STDIN]):
                 prev = c.fd_objs[STDIN]
             if STDOUT in fd:
                 ## we made sure that c.fd[STDOUT] had not been redirected before
-                c.fd_objs[STDOUT] = tempfile.TemporaryFile()
-                self.fd_objs[STDOUT] = c.fd_objs[STDOUT]
+                c.fd_objs[STDOUT] = self.fd_objs[STDOUT]
             if STDERR in fd and _is_fileno(STDERR, c.fd_objs[STDERR]):
                 c.fd_objs[STDERR] = self.fd_objs[STDERR]
-            c._popen(stdin=prev)
+            self._popen_stage(c, stdin=prev)
+            self._start_monitor()
         def cleanup():
             ## close all unneeded files
-            for c in self.cmds[:-1]:
-                if c.fd_objs[STDOUT] == PIPE:
-                    c.running_fd_objs[STDOUT].close()
+            self._stop_monitor()
+            self._close_links()
             if not set(fd) == set([1,2]):
                 self._cleanup_capture_dict(fd[0], self.fd_objs)
-            for descriptor in fd:
-            #self.running_fd_objs[descriptor].seek(0)
-                self.fd_objs[descriptor].seek(0)
 
         return runit, cleanup
 
     def capture(self, *fd, **kwargs):
        runit, cleanup  = self._capture_core(*fd, **kwargs)
 
-       if kwargs.get('timeout'):
-           timeout =  kwargs.get('timeout')
-           proc_thread = threading.Thread(target=runit)
-           proc_thread.start()
-           proc_thread.join(timeout)
-           kill_timeout = kwargs.get('kill_timeout', 0)
-           time.sleep(kill_timeout)
-           self.kill()
-       else:
-           runit()
+       runit()
+       timer = self._start_timeout(**kwargs)
 
+       dropped = self._drain_captures(fd or [1])
        #we only need to wait on the last in the pipeline, the rest
        #will die off, and since the point of capture is to grab the
        #output, once the last cmd is dead, there can be no more output
        self.cmds[-1].wait()
+       if timer:
+           timer.cancel()
         ## close all unneeded files
        cleanup()
-       self.kill()
+       self._teardown()
+       ## only now: the other stages share the offset of a capture file
+       for descriptor in fd or [1]:
+           self.fd_objs[descriptor].seek(0)
        return Capture(
            self.fd_objs[STDOUT],
            self.fd_objs[STDERR],
-           self.cmds[-1].returncode)
+           self.cmds[-1].returncode,
+           self.result, dropped,
+           dict((n, self.fd_objs[n]) for n in fd if n > 2))
 
     def capture_spawn(self, *fd, **kwargs):
-       runit, fd = self._capture_core(*fd, **kwargs)
-
-       if kwargs.get('timeout'):
-           timeout =  kwargs.get('timeout')
-           proc_thread = threading.Thread(target=runit)
-           proc_thread.start()
-           proc_thread.join(timeout)
-           kill_timeout = kwargs.get('kill_timeout', 0)
-           time.sleep(kill_timeout)
-           self.kill()
-       else:
-           runit()
-
+       runit, cleanup = self._capture_core(*fd, **kwargs)
+
+       runit()
+       self._start_timeout(**kwargs)
+
+       self._drainer = None
+       if [n for n in fd or [1]
+           if isinstance(self.fd_objs[n], _CaptureSink)]:
+           self._drainer = threading.Thread(
+               target=self._drain_captures, args=(fd or [1],))
+           self._drainer.daemon = True
+           self._drainer.start()
        JOBS.append(self)
        return LiveCapture(self)
 
@@ -610,20 +2395,1242 @@ class Pipe(Process):
         basic_popen_args.update(kwargs)
 
         prev = basic_popen_args['stdin']
-        for c in self.cmds[:-1]:
-            c._popen(stdin=prev, stdout=PIPE)
-            prev = c.running_fd_objs[STDOUT]
+        for i, c in enumerate(self.cmds[:-1]):
+            self._popen_stage(c, stdin=prev, stdout=PIPE)
+            prev = self._link(i)
 
-        self.cmds[-1]._popen(
+        self._popen_stage(
+            self.cmds[-1],
             stdin=prev,
             stdout=basic_popen_args['stdout'])
+        self._start_monitor()
+
+class _Chain(Cmd):
+    """
+    Jobs run one after the other by extproc itself, rather than by a
+    shell, see Seq, And and Or.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, *steps, **kwargs):
+        """
+        Prepare a chain of 'steps', each a Cmd, Pipe, PythonProc or chain.
+
+        :parameter fd: I/O redirections of the whole chain as with Cmd,
+                      which apply to the streams that a step did not
+                      redirect itself, must be a keyword argument
+
+        :parameter e: extra environment variables to be exported to all
+                      steps, must be a keyword argument
+
+        After a run, 'returncodes' holds the exit status of each step and
+        'times' its duration in seconds, both None for the steps that were
+        skipped.  The exit status of the chain is that of its last step
+        run.
+        """
+        if not steps:
+            raise ValueError("a chain needs at least one step")
+        self.steps = steps
+        self.e = kwargs.get('e', {})
+        for step in steps:
+            step.parent = weakref.ref(self)
+            step.e.update(self.e)
+            step.env.update(self.e)
+        self.env = os.environ.copy()
+        self.env.update(self.e)
+        self.cmd = self.cd = self.stdin_data = None
+        self.keep_fds = frozenset()
+        self.pgroup = False
+        fd = kwargs.get('fd', {})
+        self.fd_objs = DEFAULT_FD.copy()
+        self.fd_objs.update(fd)
+        for stream_num, fd_num in fd.iteritems():
+            self.fd_objs[stream_num] = self._process_fd_pair(stream_num, fd_num)
+        if self._redirect_args()['fd_map']:
+            raise ValueError(
+                "a chain can only redirect its stdin, stdout and stderr"
+                " to files, redirect its steps instead")
+        self.returncodes = [None] * len(steps)
+        self.times = [None] * len(steps)
+        self._current = None
+        self._killed = None
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__,
+                           ",\n    ".join(map(repr, self.steps)))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.steps == other.steps
+
+    @abc.abstractmethod
+    def _proceed(self, returncode):
+        """
+        Whether to run the step after one that exited with 'returncode'.
+        """
+
+    executable = None
+
+    def run(self):
+        """
+        Run the steps in this thread and return the exit status of the
+        last one run.
+        """
+        self._killed = None
+        return self._run()
+
+    def _popen(self, **kwargs):
+        ## here rather than in the thread, which a kill() may precede
+        self._killed = None
+        return super(_Chain, self)._popen(**kwargs)
+
+    def _run(self, **redirect):
+        ## 'redirect' replaces what fd_objs left to the caller
+        streams = dict((n, redirect.get(name, self.fd_objs[n])) for n, name
+                       in enumerate(('stdin', 'stdout', 'stderr')))
+        self.returncodes = [None] * len(self.steps)
+        self.times = [None] * len(self.steps)
+        returncode = 0
+        for i, step in enumerate(self.steps):
+            if self._killed:
+                return -self._killed
+            kwargs = {}
+            for n, name in enumerate(('stdin', 'stdout', 'stderr')):
+                if (_is_fileno(n, step.fd_objs[n])
+                    and not _is_fileno(n, streams[n])):
+                    kwargs[name] = streams[n]
+            start = time.time()
+            if isinstance(step, _Chain):
+                step._killed = None
+            self._current = step
+            if self._killed:
+                ## killed before it could see the step
+                self._current = None
+                return -self._killed
+            try:
+                if hasattr(step, '_run'):
+                    returncode = step._run(**kwargs)
+                else:
+                    step._popen(**kwargs)
+                    returncode = step.wait()
+            finally:
+                self._current = None
+            self.times[i] = time.time() - start
+            self.returncodes[i] = returncode
+            if not self._proceed(returncode):
+                break
+        return returncode
+
+    def _steps_main(self, stdin, stdout, stderr):
+        raise SystemExit(self._run(stdin=stdin, stdout=stdout, stderr=stderr))
+
+    @property
+    def popen_args(self):
+        return dict(py_func=self._steps_main,
+                    stdin=self.fd_objs[0],
+                    stdout=self.fd_objs[1],
+                    stderr=self.fd_objs[2])
+
+    def _popen_class(self):
+        ## spawned, the chain runs in a thread connected by OS pipes
+        import py_popen
+        return py_popen.ThreadPopen
+
+    def kill(self, sig=signal.SIGKILL):
+        """
+        Kill the running step and skip the following ones.
+        """
+        self._killed = sig
+        step = self._current
+        if step is not None and (isinstance(step, _Chain)
+                                 or hasattr(step, 'cmds')
+                                 or getattr(step, 'p', None)):
+            step.kill(sig)
+        if getattr(self, 'p', None):
+            super(_Chain, self).kill(sig)
+
+class Seq(_Chain):
+    """
+    Run every step in turn, like 'a; b; c' in sh:
+
+    >>> Seq(Sh('exit 1'), Sh('echo -n foo')).capture().stdout.read()
+    'foo'
+    """
+    def _proceed(self, returncode):
+        return True
+
+class And(_Chain):
+    """
+    Run the steps in turn until one fails, like 'a && b && c' in sh:
+
+    >>> chain = And(Cmd('true'), Cmd('false'), Cmd('true'))
+    >>> chain.run(), chain.returncodes
+    (1, [0, 1, None])
+    """
+    def _proceed(self, returncode):
+        return returncode == 0
+
+class Or(_Chain):
+    """
+    Run the steps in turn until one succeeds, like 'a || b || c' in sh:
+
+    >>> Or(Cmd('false'), Sh('echo -n bar'), Cmd('false')).capture(
+    ...     ).stdout.read()
+    'bar'
+    """
+    def _proceed(self, returncode):
+        return returncode != 0
+
+def _job_name(job):
+    if isinstance(job, Pipe):
+        return ' | '.join(_job_name(c) for c in job.cmds)
+    if isinstance(job, _Chain):
+        return repr(job)
+    if isinstance(job, PythonProc):
+        return getattr(job.py_func, '__name__', repr(job.py_func))
+    return ' '.join(map(str, job.cmd))
+
+def _spawn_job(job):
+    job.spawn()
+    if isinstance(job, Pipe):
+        job.close_links()
+
+def _job_done(job):
+    """
+    Whether every process of the spawned 'job' has exited, polling them.
+    """
+    if isinstance(job, Pipe):
+        return all(_job_done(c) for c in job.cmds)
+    return job.returncode is not None
+
+class _Node(object):
+    def __init__(self, index, job, name, cost):
+        self.index = index
+        self.job = job
+        self.name = name
+        self.cost = cost
+        self.deps = []
+        self.dependents = []
+        self.priority = None
+        self.status = 'pending'
+        self.returncode = None
+        self.start = self.end = None
+
+class Graph(object):
+    """
+    Cmd's, Pipe's and other jobs run in parallel as their dependencies
+    allow, like make -j:
+
+    >>> g = Graph(jobs=2)
+    >>> fetch = g.add(Cmd('true'), name='fetch')
+    >>> build = g.add(Sh('exit 0'), after=[fetch], name='build')
+    >>> check = g.add(Cmd('false'), after=[build], name='check')
+    >>> g.run(), g.returncodes['build'], g.returncodes['check']
+    (1, 0, 1)
+
+    The jobs are spawned as usual and polled for their termination.
+    """
+    def __init__(self, jobs=4, keep_going=False, poll_interval=0.05):
+        """
+        :param jobs: the maximum number of jobs running at once.
+
+        :param keep_going: if False, spawn nothing more after a failure
+            and only wait for the running jobs; if True, only skip the
+            jobs that depend on a failed one, like make -k.
+
+        :param poll_interval: the longest sleep between two polls of the
+            running jobs, while none of them exits.
+        """
+        if jobs < 1:
+            raise ValueError("jobs must be >= 1, got %r" % (jobs,))
+        self.jobs = jobs
+        self.keep_going = keep_going
+        self.poll_interval = poll_interval
+        self.nodes = []
+        self._by_job = {}
+        self._by_name = {}
+        self.start_time = None
+
+    def add(self, job, after=(), name=None, cost=1.0):
+        """
+        Add 'job' to be run after the jobs (or names) in 'after'.
+
+        :param name: the name of the job in returncodes and timings(),
+            its command line by default.
+
+        :param cost: an estimate of the duration of the job.  The ready
+            jobs that head the most costly paths to the end of the graph
+            are spawned first.
+
+        Return the job, to be named in the 'after' of later jobs.
+        """
+        if id(job) in self._by_job:
+            raise ValueError("%r was already added" % (job,))
+        if name is None:
+            name = _job_name(job)
+        if name in self._by_name:
+            raise ValueError("a job is already named %r" % (name,))
+        node = _Node(len(self.nodes), job, name, cost)
+        for dep in after:
+            dep = self._node(dep)
+            node.deps.append(dep)
+            dep.dependents.append(node)
+        self.nodes.append(node)
+        self._by_job[id(job)] = node
+        self._by_name[name] = node
+        return job
+
+    def _node(self, job_or_name):
+        try:
+            if isinstance(job_or_name, basestring):
+                return self._by_name[job_or_name]
+            return self._by_job[id(job_or_name)]
+        except KeyError:
+            raise ValueError("unknown job %r" % (job_or_name,))
+
+    def _prioritize(self):
+        """
+        Set the priority of each node to the cost of the most costly path
+        from it to the end of the graph.  There is no cycle, since add()
+        only takes dependencies on jobs added before.
+        """
+        pending = dict((node, len(node.dependents)) for node in self.nodes)
+        sinks = [node for node in self.nodes if not node.dependents]
+        while sinks:
+            node = sinks.pop()
+            node.priority = node.cost + max(
+                [d.priority for d in node.dependents] or [0])
+            for dep in node.deps:
+                pending[dep] -= 1
+                if not pending[dep]:
+                    sinks.append(dep)
+
+    def run(self):
+        """
+        Run the jobs and wait for them.
+
+        Return the exit status of the first job that failed, or 0.
+        """
+        self._prioritize()
+        self.start_time = time.time()
+        waiting = dict((node, len(node.deps)) for node in self.nodes)
+        ready = [(-node.priority, node.index, node) for node in self.nodes
+                 if not node.deps]
+        heapq.heapify(ready)
+        running = []
+        failure = None
+        try:
+            while ready or running:
+                while ready and len(running) < self.jobs and (
+                        failure is None or self.keep_going):
+                    node = heapq.heappop(ready)[2]
+                    self._spawn(node)
+                    running.append(node)
+                if not running:
+                    break
+                finished = self._wait_any(running)
+                for node in finished:
+                    running.remove(node)
+                    if node.returncode == 0:
+                        node.status = 'done'
+                        for d in node.dependents:
+                            waiting[d] -= 1
+                            if not waiting[d] and d.status == 'pending':
+                                heapq.heappush(
+                                    ready, (-d.priority, d.index, d))
+                    else:
+                        node.status = 'failed'
+                        if failure is None:
+                            failure = node.returncode
+                        self._skip(node.dependents)
+        except BaseException:
+            for node in running:
+                node.job.kill()
+            raise
+        for node in self.nodes:
+            if node.status == 'pending':
+                node.status = 'skipped'
+        return failure or 0
+
+    def _spawn(self, node):
+        node.status = 'running'
+        node.start = time.time()
+        _spawn_job(node.job)
+
+    def _wait_any(self, running):
+        """
+        Poll the 'running' nodes until some have exited, and return them.
+        """
+        delay = 0.001
+        while True:
+            finished = [node for node in running if _job_done(node.job)]
+            if finished:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_interval)
+        for node in finished:
+            node.end = time.time()
+            node.job.wait()
+            node.returncode = node.job.returncode
+        return finished
+
+    def _skip(self, nodes):
+        for node in nodes:
+            if node.status == 'pending':
+                node.status = 'skipped'
+                self._skip(node.dependents)
+
+    @property
+    def returncodes(self):
+        """
+        The exit status of each job that ran, by name.
+        """
+        return dict((node.name, node.returncode) for node in self.nodes
+                    if node.returncode is not None)
+
+    def timings(self):
+        """
+        Return a list of dicts, one per job in the order they were added,
+        with its 'name', the names of the jobs it came 'after', its
+        'status' ('done', 'failed', 'skipped' or 'pending'), 'returncode',
+        and its 'start' and 'end' in seconds since the run started, and
+        'seconds', or None when it did not run.  The list can be dumped
+        as JSON as it is.
+        """
+        timings = []
+        for node in self.nodes:
+            timing = dict(name=node.name,
+                          after=[d.name for d in node.deps],
+                          status=node.status, returncode=node.returncode,
+                          start=None, end=None, seconds=None)
+            if node.start is not None:
+                timing['start'] = node.start - self.start_time
+            if node.end is not None:
+                timing['end'] = node.end - self.start_time
+                timing['seconds'] = node.end - node.start
+            timings.append(timing)
+        return timings
+
+def _meminfo():
+    """
+    Return /proc/meminfo in kB by field name, or {} if there is none.
+    """
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                info[name] = int(value.split()[0])
+    except (IOError, ValueError, IndexError):
+        pass
+    return info
+
+class _QueuedJob(object):
+    def __init__(self, seq, job, tokens, priority, submitter):
+        self.seq = seq
+        self.job = job
+        self.tokens = tokens
+        self.priority = priority
+        self.submitter = submitter
+        self.status = 'pending'
+        self.returncode = None
+        self.start = self.end = None
+
+class JobQueue(object):
+    """
+    Jobs spawned as long as the resources they declare are available:
+
+    >>> q = JobQueue(resources=dict(cpu=2, mem_mb=1000, io=1))
+    >>> sort = q.submit(Cmd('true'), cpu=1, mem_mb=800)
+    >>> sort = q.submit(Sh('exit 2'), cpu=1, mem_mb=800)
+    >>> q.run()
+    2
+    >>> q.returncodes
+    [0, 2]
+
+    Here the second job only starts when the first has returned its
+    800 MB.  The pending jobs are considered by decreasing priority,
+    then in favour of the submitter that had the fewest jobs spawned so
+    far, so that submitters take turns, then first come first served.
+    A job that does not fit leaves the tokens that it lacks to the jobs
+    before it: later jobs that need them wait too, so that it is not
+    starved by a stream of smaller ones.
+    """
+    def __init__(self, resources=None, max_load=None, min_free_mb=None,
+                 poll_interval=0.05):
+        """
+        :param resources: the capacity of each resource, by token name.
+            The default is dict(cpu=<number of CPUs>, mem_mb=<total
+            memory in MB>, io=2).
+
+        :param max_load: admit nothing while the 1-minute load average
+            is at least 'max_load'.  The load average lags: it takes
+            a while to account for the jobs just spawned.
+
+        :param min_free_mb: admit nothing while less than 'min_free_mb'
+            of memory is available (MemAvailable of /proc/meminfo).
+
+        :param poll_interval: the longest sleep between two polls of the
+            running jobs.
+        """
+        if resources is None:
+            import multiprocessing
+            resources = dict(cpu=multiprocessing.cpu_count(), io=2)
+            total = _meminfo().get('MemTotal')
+            if total:
+                resources['mem_mb'] = total // 1024
+        self.resources = dict(resources)
+        self.free = dict(resources)
+        self.max_load = max_load
+        self.min_free_mb = min_free_mb
+        self.poll_interval = poll_interval
+        self.jobs = []
+        self._pending = []
+        self._running = []
+        self._served = {}
+
+    def submit(self, job, priority=0, submitter=None, **tokens):
+        """
+        Queue 'job', holding 'tokens' of the resources (e.g. cpu=1,
+        mem_mb=500) while it runs.  Higher priorities go first.
+
+        Return the job.
+        """
+        for name, n in tokens.iteritems():
+            if name not in self.resources:
+                raise ValueError("unknown resource %r" % (name,))
+            if n > self.resources[name]:
+                raise ValueError("%r needs %s %s out of %s" % (
+                    job, n, name, self.resources[name]))
+        entry = _QueuedJob(len(self.jobs), job, tokens, priority, submitter)
+        self.jobs.append(entry)
+        self._pending.append(entry)
+        return job
+
+    def _throttled(self):
+        if self.max_load is not None and os.getloadavg()[0] >= self.max_load:
+            return True
+        if self.min_free_mb is not None:
+            available = _meminfo().get('MemAvailable')
+            if available is not None and available // 1024 < self.min_free_mb:
+                return True
+        return False
+
+    def _admit(self):
+        """
+        Spawn the pending jobs that fit, returning how many were.
+        """
+        admitted = 0
+        while self._pending and not self._throttled():
+            self._pending.sort(key=lambda e: (
+                -e.priority, self._served.get(e.submitter, 0), e.seq))
+            lacking = set()
+            for entry in self._pending:
+                short = [name for name, n in entry.tokens.iteritems()
+                         if n > self.free[name]]
+                if short:
+                    lacking.update(short)
+                elif not [name for name in entry.tokens if name in lacking
+                          and entry.tokens[name]]:
+                    break
+            else:
+                return admitted
+            self._pending.remove(entry)
+            for name, n in entry.tokens.iteritems():
+                self.free[name] -= n
+            self._served[entry.submitter] = (
+                self._served.get(entry.submitter, 0) + 1)
+            entry.status = 'running'
+            entry.start = time.time()
+            self._running.append(entry)
+            try:
+                _spawn_job(entry.job)
+            except:
+                self._release(entry, None)
+                raise
+            admitted += 1
+        return admitted
+
+    def _release(self, entry, returncode):
+        self._running.remove(entry)
+        for name, n in entry.tokens.iteritems():
+            self.free[name] += n
+        entry.end = time.time()
+        entry.returncode = returncode
+        entry.status = 'done' if returncode == 0 else 'failed'
+
+    def poll(self):
+        """
+        Collect the jobs that have exited and spawn the pending ones that
+        fit, without blocking.
+
+        Return the number of jobs pending or running.
+        """
+        for entry in [e for e in self._running if _job_done(e.job)]:
+            entry.job.wait()
+            self._release(entry, entry.job.returncode)
+        self._admit()
+        return len(self._pending) + len(self._running)
+
+    def run(self):
+        """
+        Run the queued jobs and wait for them.
+
+        Return the exit status of the first submitted job that failed,
+        or 0.
+        """
+        delay = 0.001
+        try:
+            while True:
+                running = len(self._running)
+                if not self.poll():
+                    break
+                if len(self._running) != running:
+                    delay = 0.001
+                time.sleep(delay)
+                delay = min(delay * 2, self.poll_interval)
+        except BaseException:
+            for entry in self._running:
+                entry.job.kill()
+            raise
+        for entry in self.jobs:
+            if entry.status == 'failed':
+                return entry.returncode
+        return 0
+
+    @property
+    def returncodes(self):
+        """
+        The exit status of each job, in the order they were submitted.
+        """
+        return [entry.returncode for entry in self.jobs]
+
+class CoprocError(Exception):
+    pass
+
+class _Response(object):
+    """
+    The response to a request of a Coproc, to come.
+    """
+    def __init__(self, request):
+        self.request = request
+        self._event = threading.Event()
+        self._value = self._error = None
+
+    def _set(self, value=None, error=None):
+        ## the first outcome wins: a request may be failed twice
+        if not self._event.is_set():
+            self._value, self._error = value, error
+            self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the response and return it.  Raise CoprocError if the
+        coprocess died before answering, or after 'timeout' seconds.
+        """
+        if timeout is None:
+            while not self._event.is_set():
+                ## a timeout keeps us responsive to KeyboardInterrupt
+                self._event.wait(0.1)
+        elif not self._event.wait(timeout):
+            raise CoprocError("no response to %r after %ss"
+                              % (self.request, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class _CoprocRun(object):
+    """
+    One incarnation of the child of a Coproc, with the thread that reads
+    its responses.
+    """
+    def __init__(self, job, lines, delimiter):
+        self.job = job
+        self.lines = lines
+        self.delimiter = delimiter
+        self.stdin = job.running_fd_objs[STDIN]
+        self.pending = collections.deque()
+        self.dead = False
+        self.returncode = None
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        stdout = self.job.running_fd_objs[STDOUT]
+        partial = ''
+        answer = []
+        try:
+            while True:
+                try:
+                    data = os.read(stdout.fileno(), 65536)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if not data:
+                    break
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    if self.delimiter is None:
+                        answer.append(line)
+                        complete = len(answer) == self.lines
+                    else:
+                        complete = line == self.delimiter
+                        if not complete:
+                            answer.append(line)
+                    if complete:
+                        ## output nobody asked for is dropped
+                        if self.pending:
+                            self.pending.popleft()._set('\n'.join(answer))
+                        answer = []
+        finally:
+            self.dead = True
+            stdout.close()
+            self.returncode = self.job.wait()
+            self.fail_pending()
+
+    def fail_pending(self):
+        """
+        Fail the requests left unanswered by a dead child.
+        """
+        while True:
+            try:
+                response = self.pending.popleft()
+            except IndexError:
+                return
+            response._set(error=CoprocError(
+                "%s exited with status %s before answering %r"
+                % (self.job.cmd[0], self.returncode, response.request)))
+
+class Coproc(object):
+    """
+    A long-lived child answering the requests written to its stdin, e.g.
+
+    >>> square = Coproc(Sh('while read n; do echo $((n * n)); done'))
+    >>> square.query('3')
+    '9'
+    >>> responses = [square.submit(n) for n in '456']
+    >>> [r.result() for r in responses]
+    ['16', '25', '36']
+    >>> square.close()
+    0
+
+    A request is written as soon as it is submitted, whatever the number
+    of requests in flight, and the responses are matched to the requests
+    in order: a response is the next 'lines' lines of output or, given
+    a 'delimiter', the lines up to the next line equal to it.  It is
+    returned as a string without its last newline (nor the delimiter).
+
+    If the child dies, the requests in flight fail with CoprocError and,
+    unless restart=False, the next request spawns it anew.
+    """
+    def __init__(self, cmd, lines=1, delimiter=None, restart=True):
+        """
+        :param cmd: a Cmd, or a string or list to make one, with the
+            default stdin and stdout.  It is spawned on the first request.
+        """
+        if not isinstance(cmd, Cmd):
+            cmd = Cmd(cmd)
+        for n in (STDIN, STDOUT):
+            if not _is_fileno(n, cmd.fd_objs[n]):
+                raise ValueError("a coprocess needs its %d stream, not %r"
+                                 % (n, _name_or_self(cmd.fd_objs[n])))
+        self.cmd = cmd
+        self.lines = lines
+        self.delimiter = delimiter
+        self.restart = restart
+        self.restarts = 0
+        self._current = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Coproc(%r)" % (self.cmd,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _spawn(self):
+        job = self.cmd._clone()
+        job.fd_objs.update({STDIN: PIPE, STDOUT: PIPE})
+        job.spawn(append_to_jobs=False)
+        return job
+
+    def _run(self):
+        current = self._current
+        if current is None or current.dead:
+            if current is not None:
+                if not self.restart:
+                    raise CoprocError("%r has exited" % (self,))
+                self.restarts += 1
+            current = self._current = _CoprocRun(
+                self._spawn(), self.lines, self.delimiter)
+        return current
+
+    @property
+    def in_flight(self):
+        """
+        The number of requests waiting for their response.
+        """
+        current = self._current
+        return len(current.pending) if current is not None else 0
+
+    def submit(self, request):
+        """
+        Write 'request', with a newline if it lacks one, to the child.
+
+        Return the response to come: its result() method waits for it.
+        """
+        response = _Response(request)
+        if not request.endswith('\n'):
+            request += '\n'
+        with self._lock:
+            if self._closed:
+                raise CoprocError("%r is closed" % (self,))
+            current = self._run()
+            current.pending.append(response)
+            try:
+                current.stdin.write(request)
+                current.stdin.flush()
+            except (IOError, OSError):
+                ## it died: the reader fails the request at EOF
+                pass
+            if current.dead:
+                current.fail_pending()
+        return response
+
+    def query(self, request, timeout=None):
+        """
+        Submit 'request' and return its response.
+        """
+        return self.submit(request).result(timeout)
+
+    def close(self):
+        """
+        Close the stdin of the child, wait for it to answer the requests
+        in flight and exit.
+
+        Return its exit status, or None if it was never spawned.
+        """
+        with self._lock:
+            self._closed = True
+            current = self._current
+        if current is None:
+            return None
+        if not current.stdin.closed:
+            current.stdin.close()
+        while current.reader.is_alive():
+            current.reader.join(0.1)
+        return current.returncode
+
+    def kill(self, sig=signal.SIGKILL):
+        """
+        Kill the child, failing the requests in flight, and close.
+        """
+        current = self._current
+        if current is not None and not current.dead:
+            current.job.kill(sig)
+        return self.close()
+
+class CoprocPool(object):
+    """
+    'n' coprocesses of the same command, each request going to the one
+    with the fewest requests in flight, in turn among those tied:
+
+    >>> pool = CoprocPool(Cmd('cat'), n=2)
+    >>> pool.map(['a', 'b', 'c'])
+    ['a', 'b', 'c']
+    >>> pool.close()
+    [0, 0]
+    """
+    def __init__(self, cmd, n=None, **kwargs):
+        """
+        :param n: the number of coprocesses, by default the number of
+            CPUs.  The other arguments are those of Coproc.
+        """
+        if n is None:
+            import multiprocessing
+            n = multiprocessing.cpu_count()
+        self.coprocs = [Coproc(cmd, **kwargs) for _ in range(n)]
+        self._turn = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, request):
+        ## min() takes the first of the ties: without turns, a coprocess
+        ## answering fast enough would get every request
+        turn = self._turn = (self._turn + 1) % len(self.coprocs)
+        coprocs = self.coprocs[turn:] + self.coprocs[:turn]
+        return min(coprocs, key=lambda c: c.in_flight).submit(request)
+
+    def query(self, request, timeout=None):
+        return self.submit(request).result(timeout)
+
+    def map(self, requests, timeout=None):
+        """
+        Submit all of 'requests' and return their responses, in order.
+        """
+        responses = [self.submit(request) for request in requests]
+        return [response.result(timeout) for response in responses]
+
+    def close(self):
+        """
+        Close all the coprocesses and return their exit status.
+        """
+        return [coproc.close() for coproc in self.coprocs]
+
+## Linux fcntl commands, not exported by the fcntl module
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+def _pipe_max_size():
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 1 << 20
+
+def _pipe_size(f):
+    """
+    Return the capacity of pipe 'f', or None where unsupported.
+    """
+    try:
+        return fcntl.fcntl(f, F_GETPIPE_SZ)
+    except IOError:
+        return None
+
+def _set_pipe_size(f, size):
+    """
+    Set the capacity of pipe 'f', capped by pipe-max-size.
+
+    Return the new capacity, or None where unsupported.
+    """
+    try:
+        return fcntl.fcntl(f, F_SETPIPE_SZ, min(size, _pipe_max_size()))
+    except IOError:
+        return None
+
+def _pipe_queued(f):
+    """
+    Return the number of bytes waiting to be read from pipe 'f'.
+    """
+    import array, termios
+    buf = array.array('i', [0])
+    fcntl.ioctl(f, termios.FIONREAD, buf, True)
+    return buf[0]
+
+def _exited(p):
+    """
+    True if the child of Popen 'p' has terminated, waited for or not.
+    """
+    if p.returncode is not None:
+        return True
+    if p.pid is None:
+        return False
+    try:
+        with open('/proc/%d/stat' % p.pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] in 'ZX'
+    except IOError:
+        return True
+
+def _written_bytes(pid):
+    """
+    Return the bytes written so far by process 'pid', or None.
+    """
+    try:
+        with open('/proc/%d/io' % pid) as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        return None
+
+class _PipeMonitor(object):
+    """
+    Watch the links of a spawned Pipe from a background thread.
+
+    Every 'interval' seconds, each link with pipe_size 'auto' that is
+    found full has its capacity doubled, up to pipe-max-size, and the
+    counters of Pipe.metrics() are updated.  'on_metrics' is called with
+    a snapshot every 'metrics_interval' seconds.
+    """
+    def __init__(self, pipe, interval=0.01, on_metrics=None,
+                 metrics_interval=1.0):
+        self.pipe = pipe
+        self.interval = interval
+        self.on_metrics = on_metrics
+        self.metrics_interval = metrics_interval
+        self.max_size = _pipe_max_size()
+        self._stopped = False
+        self._thread = None
+
+        n = len(pipe.cmds)
+        self.start_time = self._last_sample = time.time()
+        self._last_report = self.start_time
+        self.written = [0] * (n - 1)
+        self.rates = [0.0] * (n - 1)
+        self.queued = [None] * (n - 1)
+        self.capacity = [None] * (n - 1)
+        self.blocked_read = [0.0] * n
+        self.blocked_write = [0.0] * n
+        self._reported = [0] * (n - 1)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stopped and self.sample():
+            if (self.on_metrics is not None and
+                time.time() - self._last_report >= self.metrics_interval):
+                self.report()
+            time.sleep(self.interval)
+        if self.on_metrics is not None:
+            self.report()
+
+    def report(self):
+        now = time.time()
+        elapsed = now - self._last_report
+        for i, written in enumerate(self.written):
+            self.rates[i] = (written - self._reported[i]) / (elapsed or 1)
+        self._reported = list(self.written)
+        self._last_report = now
+        self.on_metrics(self.snapshot())
+
+    def snapshot(self):
+        rates = self.rates
+        if self.on_metrics is None:
+            ## no reports: the rate is the average since the start
+            elapsed = (self._last_sample - self.start_time) or 1
+            rates = [written / elapsed for written in self.written]
+        return dict(
+            elapsed=self._last_sample - self.start_time,
+            links=[dict(written=self.written[i], rate=rates[i],
+                        queued=self.queued[i], capacity=self.capacity[i])
+                   for i in range(len(self.written))],
+            stages=[dict(pid=getattr(c.p, 'pid', None),
+                         blocked_read=self.blocked_read[i],
+                         blocked_write=self.blocked_write[i])
+                    for i, c in enumerate(self.pipe.cmds)])
+
+    def sample(self):
+        """
+        Sample every link once.  Return False when all writers are gone.
+        """
+        now = time.time()
+        dt, self._last_sample = now - self._last_sample, now
+        measure = self.pipe.monitor or self.on_metrics
+        watching = False
+        for i, size in enumerate(self.pipe.pipe_sizes):
+            with self.pipe._links_lock:
+                watching = self._sample_link(i, size, measure, dt) or watching
+        return watching
+
+    def _sample_link(self, i, size, measure, dt):
+        """
+        Sample link 'i'.  Return whether its writer is still watched.
+        """
+        c = self.pipe.cmds[i]
+        f = c.running_fd_objs[STDOUT]
+        if f is None or f.closed or _exited(c.p):
+            return False
+        if _exited(self.pipe.cmds[i + 1].p):
+            ## our copy of the link must not keep the writer from
+            ## getting EPIPE
+            self.pipe._close_link(i)
+            return False
+        if size != 'auto' and not measure:
+            return True
+        capacity = _pipe_size(f)
+        queued = _pipe_queued(f)
+        if measure:
+            if c.p.pid is not None:
+                written = _written_bytes(c.p.pid)
+                if written is not None:
+                    if written and _TRACER is not None:
+                        _TRACER.output(c.p.pid)
+                    self.written[i] = written
+            self.queued[i], self.capacity[i] = queued, capacity
+            if capacity is not None and queued >= capacity - 4096:
+                self.blocked_write[i] += dt
+            elif queued == 0:
+                self.blocked_read[i + 1] += dt
+        if (size == 'auto' and capacity is not None
+            and capacity < self.max_size and queued >= capacity - 4096):
+            _set_pipe_size(f, capacity * 2)
+        return True
+
+_FRAME_HEADER = struct.Struct('>I')
+
+def _frame_codec(codec):
+    if codec == 'pickle':
+        import cPickle
+        return (lambda batch: cPickle.dumps(batch, -1)), cPickle.loads
+    elif codec == 'marshal':
+        import marshal
+        return marshal.dumps, marshal.loads
+    raise ValueError("unknown codec %r" % (codec,))
+
+def _read_frames(f, codec):
+    """
+    Yield the records of the length-prefixed batches read from 'f'.
+    """
+    loads = _frame_codec(codec)[1]
+    header_size = _FRAME_HEADER.size
+    while True:
+        header = f.read(header_size)
+        if len(header) < header_size:
+            return
+        for record in loads(f.read(_FRAME_HEADER.unpack(header)[0])):
+            yield record
+
+def _write_frames(f, records, batch_size, codec):
+    """
+    Write 'records' to 'f' as length-prefixed batches of 'batch_size'.
+    """
+    dumps = _frame_codec(codec)[0]
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            payload = dumps(batch)
+            f.write(_FRAME_HEADER.pack(len(payload)) + payload)
+            batch = []
+    if batch:
+        payload = dumps(batch)
+        f.write(_FRAME_HEADER.pack(len(payload)) + payload)
+    f.flush()
+
+def _write_lines(f, records):
+    for record in records:
+        line = record if isinstance(record, str) else '%s' % (record,)
+        if not line.endswith('\n'):
+            line += '\n'
+        f.write(line)
+    f.flush()
+
+class _MergedProfile(object):
+    """
+    Profile stats for pstats.Stats to load.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class ProfileRegistry(object):
+    """
+    The profiles of the PythonProc's run with profile=True, merged
+    across all their stages and runs, see PROFILES.
+
+    >>> PROFILES.clear()
+    >>> PythonProc(lambda i, o, e: sorted(range(10)), profile=True).run()
+    0
+    >>> PROFILES.runs
+    1
+    >>> PROFILES.stats().total_calls > 0
+    True
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def add(self, stats):
+        """
+        Merge 'stats', the stats dict of the profile of one child.
+        """
+        import pstats
+        with self._lock:
+            for func, stat in stats.iteritems():
+                if func in self._stats:
+                    stat = pstats.add_func_stats(self._stats[func], stat)
+                self._stats[func] = stat
+            self.runs += 1
+
+    def clear(self):
+        self._stats = {}
+        self.runs = 0
+
+    def stats(self, stream=None):
+        """
+        Return a pstats.Stats of the merged profiles, printing to
+        'stream', or None if there are none yet.
+        """
+        import pstats
+        if not self.runs:
+            return None
+        return pstats.Stats(_MergedProfile(dict(self._stats)), stream=stream)
+
+PROFILES = ProfileRegistry()
 
 class PythonProc(Cmd):
-    def __init__(self, py_func, fd={}, e={}, cd=None):
+    def __init__(self, py_func, fd={}, e={}, cd=None, keep_fds=(),
+                 objects=False, batch_size=1024, codec='pickle',
+                 mode='fork', pgroup=False, profile=False):
         """
+        Prepare for a fork of 'py_func', which is called in the child
+        as py_func(stdin, stdout, stderr) with open file objects.
+
+        As with Cmd, fds >= 3 other than 'keep_fds' are closed in the
+        child before 'py_func' is called.
+
+        :param objects: if True, 'py_func' is called as py_func(records)
+            and must return an iterable of records.  Between two adjacent
+            object-mode stages of a Pipe, records travel as batches of
+            'batch_size' serialized with the writer's 'codec' ('pickle'
+            or 'marshal').
+            Next to anything else, the input records are the lines of
+            stdin and each output record is written as a line, '%s' of
+            it with a newline unless it already ends with one.
+
+        :param mode: 'fork' to run 'py_func' in a forked child, or
+            'thread' to run it in a thread of this process, connected to
+            its neighbours by OS pipes.  A thread starts much faster and
+            shares this process's memory, but 'cd' and 'e' do not apply
+            to it.  Its exit status is 1 if 'py_func' raised, 0 otherwise;
+            the exception is not re-raised but kept as 'p.exception'.
+
+        :param pgroup: as with Cmd, for the 'fork' mode.
+
+        :param profile: if True, run 'py_func' under cProfile in the
+            child, which sends the stats back along with the result, to
+            be merged into PROFILES.  For the 'fork' mode only.
         """
         self.py_func = py_func
         self.cd = cd
+        self.keep_fds = frozenset(keep_fds)
+        self.pgroup = pgroup
+        self.objects = objects
+        self.batch_size = batch_size
+        self.codec = codec
+        _frame_codec(codec)
+        if mode not in ('fork', 'thread'):
+            raise ValueError("mode must be either 'fork' or 'thread'")
+        if profile and mode != 'fork':
+            raise ValueError("only the 'fork' mode can be profiled")
+        self.mode = mode
+        self.profile = profile
+        ## the codec of the framed input link, if any
+        self.framed_in = None
+        self.framed_out = False
         self.e = e
         self.env = os.environ.copy()
         self.env.update(e)
@@ -633,20 +3640,135 @@ class PythonProc(Cmd):
         for stream_num, fd_num in fd.iteritems():
             self.fd_objs[stream_num] = self._process_fd_pair(stream_num, fd_num)
 
+    def _object_stream(self, stdin, stdout, stderr):
+        if self.framed_in:
+            records = _read_frames(stdin, self.framed_in)
+        else:
+            records = iter(stdin.readline, '')
+        out_records = self.py_func(records)
+        if out_records is None:
+            return
+        if self.framed_out:
+            _write_frames(stdout, out_records, self.batch_size, self.codec)
+        else:
+            _write_lines(stdout, out_records)
+
     @property
     def popen_args(self):
+        py_func = self._object_stream if self.objects else self.py_func
         return dict(
-            py_func=self.py_func, cwd=self.cd, env=self.env,
-            stdin=self.fd_objs[0],
-            stdout=self.fd_objs[1],
-            stderr=self.fd_objs[2])
+            py_func=py_func, cwd=self.cd, env=self.env,
+            close_fds=True, keep_fds=self.keep_fds,
+            pgid=0 if self.pgroup else None, profile=self.profile,
+            **self._redirect_args())
+
+    executable = None
+
+    def _clone(self):
+        c = type(self).__new__(type(self))
+        c.py_func = self.py_func
+        c.cd = self.cd
+        c.keep_fds = self.keep_fds
+        c.pgroup = self.pgroup
+        c.objects = self.objects
+        c.batch_size = self.batch_size
+        c.codec = self.codec
+        c.mode = self.mode
+        c.profile = self.profile
+        c.framed_in = self.framed_in
+        c.framed_out = self.framed_out
+        c.e = self.e.copy()
+        c.env = self.env.copy()
+        c.fd_objs = self.fd_objs.copy()
+        return c
+
+    def _new_popen(self, popen_args):
+        p = super(PythonProc, self)._new_popen(popen_args)
+        if self.profile:
+            p.on_profile = PROFILES.add
+        return p
+
+    def _popen_class(self):
+        import py_popen
+        if self.mode == 'thread':
+            return py_popen.ThreadPopen
+        return py_popen.PyPopen
+
+    @property
+    def result(self):
+        """
+        The return value of 'py_func' once it has returned.
+
+        The value is pickled in the child and streamed back on a pipe
+        of its own, so there is no limit on its size.
+        """
+        return self.p.result
+
+class _FusedProc(PythonProc):
+    """
+    A series of object-mode PythonProc's run in a single forked child.
+    """
+    def __init__(self, members):
+        first, last = members[0], members[-1]
+        keep_fds = frozenset().union(*[m.keep_fds for m in members])
+        super(_FusedProc, self).__init__(
+            self._chain, cd=first.cd, keep_fds=keep_fds, objects=True,
+            batch_size=last.batch_size, codec=last.codec, mode=first.mode,
+            profile=first.profile)
+        self.members = members
+        self.e = first.e
+        self.env = first.env
+        self.fd_objs = {STDIN: first.fd_objs[STDIN],
+                        STDOUT: last.fd_objs[STDOUT],
+                        STDERR: first.fd_objs[STDERR]}
+
+    def __repr__(self):
+        return "_FusedProc(%r)" % (self.members,)
+
+    def _chain(self, records):
+        for m in self.members:
+            records = m.py_func(records)
+        return records
 
     def _popen(self, **kwargs):
-        basic_popen_args = self.popen_args
-        basic_popen_args.update(kwargs)
-        ab = py_popen.PyPopen(**basic_popen_args)
-        self.p = decorate_popen(ab)
-        return self.p
+        p = super(_FusedProc, self)._popen(**kwargs)
+        for m in self.members:
+            m.p = p
+        return p
+
+def _object_link(a, b):
+    """
+    True if the output of 'a' is piped straight into object-mode 'b'.
+    """
+    return (getattr(a, 'objects', False) and getattr(b, 'objects', False)
+            and a.fd_objs[STDOUT] == PIPE
+            and _is_fileno(STDIN, b.fd_objs[STDIN]))
+
+def _own_settings(c):
+    """
+    True if stage 'c' has settings that a _FusedProc would not carry
+    over: its own process group, or redirections of fds >= 3.
+    """
+    return c.pgroup or any(n > STDERR for n in c.fd_objs)
+
+def _fuse_stages(cmds):
+    """
+    Replace each run of fusable PythonProc's in 'cmds' by a _FusedProc.
+    """
+    stages = []
+    run = [cmds[0]]
+    for a, b in zip(cmds[:-1], cmds[1:]):
+        if (_object_link(a, b) and not _own_settings(a)
+            and not _own_settings(b)
+            and a.fd_objs[STDERR] == b.fd_objs[STDERR]
+            and a.cd == b.cd and a.env == b.env and a.mode == b.mode
+            and a.profile == b.profile):
+            run.append(b)
+            continue
+        stages.append(run[0] if len(run) == 1 else _FusedProc(run))
+        run = [b]
+    stages.append(run[0] if len(run) == 1 else _FusedProc(run))
+    return tuple(stages)
 
 def fork_dec(f):
     return PythonProc(f)
@@ -1,17 +1,247 @@
 import os
 import sys
+import select
+import errno
+import fcntl
+import threading
 import traceback
 import pickle
-from subprocess import Popen, _cleanup, mswindows, gc, _eintr_retry_call
+import cStringIO
+from subprocess import (
+    Popen, PIPE, STDOUT, _cleanup, mswindows, gc, _eintr_retry_call)
+
+try:
+    MAXFD = os.sysconf("SC_OPEN_MAX")
+except (AttributeError, ValueError):
+    MAXFD = 256
+
+def open_fds():
+    """
+    Return a sorted list of the file descriptors open in this process.
+
+    /proc/self/fd (Linux) or /dev/fd (BSD, OS X) is listed so that the
+    cost is proportional to the number of open fds, not to SC_OPEN_MAX.
+    The listing may contain the fd used to read the directory itself,
+    which is already closed by the time this returns.
+    """
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            names = os.listdir(fd_dir)
+        except OSError:
+            continue
+        return sorted(int(n) for n in names if n.isdigit())
+    return range(MAXFD)
+
+def close_all_fds(keep=(), lowest=3):
+    """
+    Close every file descriptor >= lowest that is not in keep.
+    """
+    keep = set(keep)
+    for fd in open_fds():
+        if fd < lowest or fd in keep:
+            continue
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def _pgroup_preexec(pgid, preexec_fn=None):
+    """
+    Return a preexec_fn that moves the child into process group 'pgid',
+    or a new group that it leads if 'pgid' is 0, then calls 'preexec_fn'.
+    """
+    def preexec():
+        try:
+            os.setpgid(0, pgid)
+        except OSError:
+            # the group is gone: lead one of our own
+            os.setpgid(0, 0)
+        if preexec_fn:
+            preexec_fn()
+    return preexec
+
+class _UnpicklableResult(object):
+    """
+    Sent by the child in place of a return value that cannot be pickled.
+    """
+    def __init__(self, message):
+        self.message = message
+
+def _write_all(fd, data):
+    while data:
+        n = _eintr_retry_call(os.write, fd, data)
+        data = data[n:]
+
+class ExtPopen(Popen):
+    """
+    A Popen that closes the child's inherited fds by default.
+
+    Every fd >= 3 is closed before exec except those listed in
+    'keep_fds'.  Unlike Popen._close_fds, which loops up to MAXFD,
+    only the fds that are actually open are visited.
+
+    If 'pgid' is not None, the child is moved into that process group, or
+    a new group that it leads if 'pgid' is 0; 'self.pgid' is then the id
+    of its group.
+
+    'fd_map' maps fds of the child to the fd they become a copy of, or
+    to None to close them.  It is applied once stdin, stdout and stderr
+    are set up, so {1: 2} sends stdout where stderr goes, and {3: 1}
+    opens fd 3 on stdout.  The source fds are copied before any target
+    is replaced, so that the map may swap fds.
+    """
+    def __init__(self, *args, **kwargs):
+        self.keep_fds = frozenset(kwargs.pop('keep_fds', ()))
+        self.fd_map = dict(kwargs.pop('fd_map', None) or {})
+        pgid = kwargs.pop('pgid', None)
+        if pgid is not None:
+            kwargs['preexec_fn'] = _pgroup_preexec(
+                pgid, kwargs.get('preexec_fn'))
+        kwargs.setdefault('close_fds', True)
+        if self.fd_map and not kwargs['close_fds']:
+            raise ValueError("fd_map is only applied with close_fds")
+        super(ExtPopen, self).__init__(*args, **kwargs)
+        self._set_pgid(pgid)
+
+    # called with the Popen once its child has been reaped, see trace()
+    on_exit = None
+
+    # no globals: Popen.__del__ may reap the child at interpreter exit
+    _popen_handle_exitstatus = Popen._handle_exitstatus.im_func
+
+    def _handle_exitstatus(self, sts, *args):
+        self._popen_handle_exitstatus(sts, *args)
+        if self.on_exit is not None:
+            self.on_exit(self)
+
+    def _set_pgid(self, pgid):
+        self.pgid = None
+        if pgid is None:
+            return
+        # also done here so that the group exists as soon as we return,
+        # whether or not the child has run its preexec_fn yet
+        self.pgid = pgid or self.pid
+        try:
+            os.setpgid(self.pid, self.pgid)
+        except OSError, e:
+            # EACCES: the child has already exec'ed, after moving itself
+            if e.errno == errno.EPERM:
+                # the group is gone: the child leads its own
+                self.pgid = self.pid
+
+    def pipe_cloexec(self):
+        # Popen writes an exec failure to its error pipe after
+        # _close_fds: the pipe must not be a target that _map_fds would
+        # have to move, so all the pipes of the child are put above them
+        r, w = super(ExtPopen, self).pipe_cloexec()
+        if not self.fd_map:
+            return r, w
+        top = max(self.fd_map.keys() + self._map_sources()) + 1
+        return self._above(r, top), self._above(w, top)
+
+    def _above(self, fd, top):
+        if fd >= top:
+            return fd
+        new_fd = fcntl.fcntl(fd, fcntl.F_DUPFD, top)
+        self._set_cloexec_flag(new_fd)
+        os.close(fd)
+        return new_fd
+
+    def _close_fds(self, but):
+        self._close_unmapped(but)
+        # pipe_cloexec made sure that 'but' is not moved
+        self._map_fds(but)
+
+    def _map_sources(self):
+        return [fd for fd in self.fd_map.itervalues() if fd is not None]
+
+    def _close_unmapped(self, but):
+        close_all_fds(keep=self.keep_fds.union([but], self._map_sources()))
+        for fd in self.keep_fds:
+            # fds opened by Python (e.g. tempfile) are usually close-on-exec
+            try:
+                self._set_cloexec_flag(fd, False)
+            except (IOError, OSError):
+                pass
+
+    def _map_fds(self, *reserved):
+        """
+        Apply 'fd_map' in the child, then close the sources that are
+        neither targets nor kept.
+
+        Return the fds 'reserved', moved above the targets if need be:
+        the pipes to the parent are created after the fds of the map,
+        and may well have their numbers.
+        """
+        if not self.fd_map:
+            return reserved
+        sources = self._map_sources()
+        top = max(self.fd_map.keys() + sources + list(reserved)) + 1
+
+        def copy(fd):
+            new_fd = fcntl.fcntl(fd, fcntl.F_DUPFD, top)
+            self._set_cloexec_flag(new_fd)
+            return new_fd
+        reserved = tuple(copy(fd) if fd in self.fd_map else fd
+                         for fd in reserved)
+        copies = dict((target, copy(source))
+                      for target, source in self.fd_map.iteritems()
+                      if source is not None)
+        for target, source in self.fd_map.iteritems():
+            if source is None:
+                try:
+                    os.close(target)
+                except OSError:
+                    pass
+            else:
+                # dup2 also clears close-on-exec, as for {3: 3}
+                os.dup2(copies[target], target)
+        for fd in copies.values():
+            os.close(fd)
+        for fd in set(sources).difference(self.fd_map, self.keep_fds):
+            if fd > 2:
+                os.close(fd)
+        return reserved
+
+def _profile_stats(profiler):
+    """
+    Return the stats dict of 'profiler', as pstats.Stats reads it.
+    """
+    profiler.create_stats()
+    return profiler.stats
+
+class PyPopen(ExtPopen):
+    # called with the stats dict of a child run with profile=True, once
+    # they have been read
+    on_profile = None
 
-class PyPopen(Popen):
     def __init__(self, py_func, bufsize=0, executable=None,
                  stdin=None, stdout=None, stderr=None,
-                 preexec_fn=None, close_fds=False, shell=False,
+                 preexec_fn=None, close_fds=True, shell=False,
                  cwd=None, env=None, universal_newlines=False,
-                 startupinfo=None, creationflags=0):
-        """Create new Popen instance."""
+                 startupinfo=None, creationflags=0, keep_fds=(), pgid=None,
+                 fd_map=None, profile=False):
+        """Create new Popen instance.
+
+        If 'profile' is True, py_func is run under cProfile in the child,
+        which ships the stats after its return value: they are then
+        'profile_stats', a dict as in pstats.Stats, even if py_func
+        raised.
+        """
         _cleanup()
+        if pgid is not None:
+            preexec_fn = _pgroup_preexec(pgid, preexec_fn)
+
+        self.keep_fds = frozenset(keep_fds)
+        self.fd_map = dict(fd_map or {})
+        self.profile = profile
+        self.profile_stats = None
+        # fd -> 'result' or 'error', for the pipes still to be read
+        self._open_pipes = {}
+        self._chunks = dict(result=[], error=[])
+        self._result = None
+        self.result_error = None
+        self._child_exception = None
 
         self._child_created = False
         if not isinstance(bufsize, (int, long)):
@@ -56,9 +286,14 @@ class PyPopen(Popen):
         # are None when not using PIPEs. The child objects are None
         # when not redirecting.
 
+        handles = self._get_handles(stdin, stdout, stderr)
+        if len(handles) == 2:
+            # newer 2.7 releases also return the set of fds to close
+            # if the fork fails
+            handles, to_close = handles
         (p2cread, p2cwrite,
          c2pread, c2pwrite,
-         errread, errwrite) = self._get_handles(stdin, stdout, stderr)
+         errread, errwrite) = handles
 
         self._execute_child(py_func, executable, preexec_fn, close_fds,
                             cwd, env, universal_newlines,
@@ -66,6 +301,7 @@ class PyPopen(Popen):
                             p2cread, p2cwrite,
                             c2pread, c2pwrite,
                             errread, errwrite)
+        self._set_pgid(pgid)
 
         if mswindows:
             if p2cwrite is not None:
@@ -97,13 +333,19 @@ class PyPopen(Popen):
                        errread, errwrite):
         """Execute program (POSIX version)"""
 
-        # For transferring possible exec failure from child to parent
-        # The first char specifies the exception type: 0 means
-        # OSError, 1 means some other error.
+        # For transferring an exception raised by py_func from child to
+        # parent, and py_func's return value on the separate result pipe.
+        # Both are read as the child writes them, see _read_pipes().
+        if self.profile:
+            # rather than in the child
+            import cProfile
         errpipe_read, errpipe_write = os.pipe()
+        resultpipe_read, resultpipe_write = os.pipe()
         try:
             try:
                 self._set_cloexec_flag(errpipe_write)
+                self._set_cloexec_flag(errpipe_read)
+                self._set_cloexec_flag(resultpipe_read)
 
                 gc_was_enabled = gc.isenabled()
                 # Disable gc to avoid bug where gc -> file_dealloc ->
@@ -118,6 +360,8 @@ class PyPopen(Popen):
                 self._child_created = True
                 if self.pid == 0:
                     # Child
+                    result_file = None
+                    profiler = None
                     try:
                         # Close parent's pipe ends
                         if p2cwrite is not None:
@@ -127,6 +371,7 @@ class PyPopen(Popen):
                         if errread is not None:
                             os.close(errread)
                         os.close(errpipe_read)
+                        os.close(resultpipe_read)
 
                         # Dup fds for child
                         if p2cread is not None:
@@ -147,7 +392,11 @@ class PyPopen(Popen):
 
                         # Close all other fds, if asked for
                         if close_fds:
-                            self._close_fds(but=errpipe_write)
+                            self.keep_fds = self.keep_fds.union(
+                                [resultpipe_write])
+                            self._close_unmapped(but=errpipe_write)
+                        errpipe_write, resultpipe_write = self._map_fds(
+                            errpipe_write, resultpipe_write)
 
                         if cwd is not None:
                             os.chdir(cwd)
@@ -159,19 +408,64 @@ class PyPopen(Popen):
                         child_stdout = os.fdopen(1, "w")
                         child_stderr = os.fdopen(2, "w")
                         #call the child function
-                        py_func(child_stdin, child_stdout, child_stderr)
+                        if self.profile:
+                            profiler = cProfile.Profile()
+                            result = profiler.runcall(
+                                py_func, child_stdin, child_stdout,
+                                child_stderr)
+                        else:
+                            result = py_func(child_stdin, child_stdout,
+                                             child_stderr)
                         child_stdin.close()
                         child_stdout.close()
                         child_stderr.close()
 
+                        # a result that cannot be pickled is not an
+                        # error of py_func, which has returned
+                        try:
+                            data = pickle.dumps(result,
+                                                pickle.HIGHEST_PROTOCOL)
+                        except Exception, e:
+                            data = pickle.dumps(
+                                _UnpicklableResult(
+                                    "%s: %s" % (type(e).__name__, e)),
+                                pickle.HIGHEST_PROTOCOL)
+                        # the parent may only drain the result pipe when
+                        # it waits for us, so it is streamed rather than
+                        # written in one go
+                        result_file = os.fdopen(resultpipe_write, 'wb')
+                        result_file.write(data)
+                        del data
+                        if profiler is not None:
+                            pickle.dump(_profile_stats(profiler),
+                                        result_file, pickle.HIGHEST_PROTOCOL)
+                        result_file.close()
+
                     except:
                         exc_type, exc_value, tb = sys.exc_info()
+                        # The parent reads the result pipe to EOF before
+                        # the error pipe, so close it first.
+                        try:
+                            if result_file is None and profiler is not None:
+                                # the profile of py_func up to the raise
+                                result_file = os.fdopen(resultpipe_write, 'wb')
+                                pickle.dump(None, result_file,
+                                            pickle.HIGHEST_PROTOCOL)
+                                pickle.dump(_profile_stats(profiler),
+                                            result_file,
+                                            pickle.HIGHEST_PROTOCOL)
+                            if result_file is None:
+                                os.close(resultpipe_write)
+                            else:
+                                result_file.close()
+                        except Exception:
+                            pass
                         # Save the traceback and attach it to the exception object
                         exc_lines = traceback.format_exception(exc_type,
                                                                exc_value,
                                                                tb)
                         exc_value.child_traceback = ''.join(exc_lines)
-                        os.write(errpipe_write, pickle.dumps(exc_value))
+                        _write_all(errpipe_write, pickle.dumps(exc_value))
 
                     # This exitcode won't be reported to applications, so it
                     # really doesn't matter what we return.
@@ -186,6 +480,7 @@ class PyPopen(Popen):
             finally:
                 # be sure the FD is closed no matter what
                 os.close(errpipe_write)
+                os.close(resultpipe_write)
 
             if p2cread is not None and p2cwrite is not None:
                 os.close(p2cread)
@@ -193,20 +488,221 @@ class PyPopen(Popen):
                 os.close(c2pwrite)
             if errwrite is not None and errread is not None:
                 os.close(errwrite)
-
-            # Wait for exec to fail or succeed; possibly raising exception
-            # Exception limited to 1M
-            data = _eintr_retry_call(os.read, errpipe_read, 1048576)
-        finally:
-            # be sure the FD is closed no matter what
-            #pass
+        except:
             os.close(errpipe_read)
+            os.close(resultpipe_read)
+            raise
+
+        self._open_pipes = {resultpipe_read: 'result',
+                            errpipe_read: 'error'}
 
-        if data != "":
-            print data
-            _eintr_retry_call(os.waitpid, self.pid, 0)
-            child_exception = pickle.loads(data)
-            for fd in (p2cwrite, c2pread, errread):
-                if fd is not None:
+    def _read_pipes(self, block=False):
+        """
+        Read what the child has written so far on the result and error
+        pipes, or all of it if 'block'.  They are read whenever the child
+        is polled too: a result bigger than the pipe buffer would
+        otherwise keep it from ever exiting.  Once the child has closed
+        both, its result, profile and exception are unpickled.
+        """
+        while self._open_pipes:
+            # not select(): the fds may be above FD_SETSIZE
+            poller = select.poll()
+            for fd in self._open_pipes:
+                poller.register(fd, select.POLLIN)
+            ready = _eintr_retry_call(poller.poll, None if block else 0)
+            if not ready:
+                return
+            for fd, _ in ready:
+                data = _eintr_retry_call(os.read, fd, 65536)
+                if data:
+                    self._chunks[self._open_pipes[fd]].append(data)
+                else:
                     os.close(fd)
+                    del self._open_pipes[fd]
+        if self._chunks is not None:
+            self._unpickle()
+
+    def _unpickle(self):
+        chunks, self._chunks = self._chunks, None
+        result_file = cStringIO.StringIO("".join(chunks['result']))
+        try:
+            self._result = pickle.load(result_file)
+            if self.profile:
+                self.profile_stats = pickle.load(result_file)
+        except (EOFError, pickle.UnpicklingError):
+            # nothing or a truncated pickle: py_func raised, or the child
+            # died
+            pass
+        except Exception, e:
+            # e.g. a result of a class that we cannot import
+            self.result_error = e
+        if isinstance(self._result, _UnpicklableResult):
+            self.result_error = pickle.PicklingError(
+                "the result could not be pickled: %s" %
+                self._result.message)
+            self._result = None
+        if self.profile_stats is not None and self.on_profile is not None:
+            self.on_profile(self.profile_stats)
+        if chunks['error']:
+            self._child_exception = pickle.loads("".join(chunks['error']))
+
+    # no globals: Popen.__del__ may poll the child at interpreter exit
+    _popen_internal_poll = Popen._internal_poll.im_func
+
+    def _internal_poll(self, *args, **kwargs):
+        if self._open_pipes:
+            self._read_pipes()
+        returncode = self._popen_internal_poll(*args, **kwargs)
+        if returncode is not None and self._open_pipes:
+            # the child has written everything by now
+            self._read_pipes()
+        return returncode
+
+    def __del__(self, *args, **kwargs):
+        for fd in self._open_pipes:
+            os.close(fd)
+        self._open_pipes = {}
+        super(PyPopen, self).__del__(*args, **kwargs)
+
+    @property
+    def result(self):
+        """
+        The return value of py_func, available once it has returned.
+
+        Reading this blocks until the child has written its result.  It
+        is None if the result could not be pickled in the child or
+        unpickled here, with the exception raised as 'result_error'.
+        """
+        self._read_pipes(block=True)
+        return self._result
+
+    def wait(self):
+        """
+        Wait for the child to terminate and return its exit status.
+
+        An exception raised by py_func in the child is re-raised here,
+        with its formatted traceback as the 'child_traceback' attribute:
+        the constructor does not wait for py_func to return.
+        """
+        self._read_pipes(block=True)
+        returncode = super(PyPopen, self).wait()
+        child_exception, self._child_exception = self._child_exception, None
+        if child_exception is not None:
             raise child_exception
+        return returncode
+
+
+class ThreadPopen(object):
+    """
+    A Popen look-alike that runs py_func in a thread of this process.
+
+    The thread is connected to its neighbours through real OS pipes,
+    so it can sit between forked children in a pipeline.  There is no
+    pid: the exit status is 0 if py_func returned and 1 if it raised,
+    in which case the exception is kept as 'exception', unless it raised
+    SystemExit, whose code is the exit status as for a process.
+
+    'cwd' and 'env' cannot be changed for a thread and are ignored.
+    """
+    def __init__(self, py_func, bufsize=0, stdin=None, stdout=None,
+                 stderr=None, **kwargs):
+        if kwargs.get('fd_map'):
+            raise ValueError("the fds of a thread cannot be redirected")
+        self.pid = None
+        self.returncode = None
+        self.exception = None
+        self._result = None
+        self.stdin = self.stdout = self.stderr = None
+
+        child_stdin = self._child_fd(0, stdin, bufsize)
+        child_stdout = self._child_fd(1, stdout, bufsize)
+        if stderr == STDOUT:
+            child_stderr = self._child_fd(2, child_stdout, bufsize)
+        else:
+            child_stderr = self._child_fd(2, stderr, bufsize)
+
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(py_func, child_stdin, child_stdout, child_stderr))
+        self._thread.daemon = True
+        self._thread.start()
+
+    _set_cloexec_flag = Popen._set_cloexec_flag.im_func
+
+    def _child_fd(self, stream_num, target, bufsize):
+        """
+        Return an fd owned by the thread for its 'stream_num' stream,
+        creating a pipe and the parent's end of it for PIPE.
+        """
+        if target == PIPE:
+            read_fd, write_fd = os.pipe()
+            self._set_cloexec_flag(read_fd)
+            self._set_cloexec_flag(write_fd)
+            if stream_num == 0:
+                fd, parent_fd, mode = read_fd, write_fd, 'wb'
+            else:
+                fd, parent_fd, mode = write_fd, read_fd, 'rb'
+            setattr(self, ('stdin', 'stdout', 'stderr')[stream_num],
+                    os.fdopen(parent_fd, mode, bufsize))
+            return fd
+        if target is None:
+            target = stream_num
+        elif not isinstance(target, (int, long)):
+            target = target.fileno()
+        fd = os.dup(target)
+        self._set_cloexec_flag(fd)
+        return fd
+
+    def _run(self, py_func, stdin_fd, stdout_fd, stderr_fd):
+        stdin = os.fdopen(stdin_fd, 'r')
+        stdout = os.fdopen(stdout_fd, 'w')
+        stderr = os.fdopen(stderr_fd, 'w')
+        try:
+            self._result = py_func(stdin, stdout, stderr)
+            returncode = 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, (int, long)):
+                returncode = e.code or 0
+            else:
+                returncode = 1
+        except:
+            exc_type, exc_value, tb = sys.exc_info()
+            exc_value.child_traceback = ''.join(
+                traceback.format_exception(exc_type, exc_value, tb))
+            self.exception = exc_value
+            returncode = 1
+        for f in (stdin, stdout, stderr):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        self.returncode = returncode
+
+    @property
+    def result(self):
+        self._thread.join()
+        return self._result
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self._thread.is_alive():
+            # a timeout keeps the main thread responsive to KeyboardInterrupt
+            self._thread.join(0.1)
+        return self.returncode
+
+    def send_signal(self, sig):
+        """
+        A thread cannot be signalled: close our ends of its pipes so that
+        it sees EOF or EPIPE.
+        """
+        for f in (self.stdin, self.stdout, self.stderr):
+            if f is not None:
+                f.close()
+
+    def terminate(self):
+        self.send_signal(None)
+
+    def kill(self):
+        self.send_signal(None)
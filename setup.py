@@ -58,5 +58,5 @@ setup(
 	url = 'http://github.com/aht/extproc/',
 	platforms=['any'],
 	classifiers=filter(None, classifiers.split("\n")),
-	py_modules = ['extproc']
+	py_modules = ['extproc', 'py_popen']
 )
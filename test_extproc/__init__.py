@@ -1,6 +1,9 @@
 import unittest
 import test_lib
-from extproc_test import ExtProcPipeTest, ExtProcCmdTest, ExtPipeSyntaxtTest
+from extproc_test import (
+    ExtProcPipeTest, ExtProcCmdTest, PythonProcTest, ExtPipeSyntaxtTest,
+    ImportTimeTest, PipeSizeBenchmark, ChainTest, GraphTest,
+    JobQueueTest, CoprocTest, SoakTest)
 from convience_test import LowerCaseTest
 
 if __name__ == '__main__':
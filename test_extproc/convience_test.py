@@ -1,5 +1,6 @@
 import os
 import tempfile
+import weakref
 from test_extproc.test_lib import ExtProcTest, STDIN, STDOUT, STDERR
 from convience import run, sh, pipe, here, cmd
 from extproc import Sh, Cmd, JOBS, Pipe
@@ -17,8 +18,9 @@ class LowerCaseTest(ExtProcTest):
         """ test Cmd ENV """
         self.assertSh(sh('echo $var', e={'var': 'foobar'}), 'foobar')
 
+        ## stdout is redirected to stderr, it cannot be captured
         self.assertRaises(
-            NotImplementedError,
+            ValueError,
             lambda: sh('echo foo; echo bar >&2', {1: 2}))
 
         ### test Pipe ENV
@@ -79,3 +81,13 @@ class LowerCaseTest(ExtProcTest):
 
     def test_here(self):
         self.assertSh(cmd('cat', {0: here("foo bar")}), 'foo bar')
+        f = here('foo')
+        out = tempfile.TemporaryFile()
+        c = Cmd('cat', {0: f, 1: out})
+        self.assertEquals([c.run(), c.run()], [0, 0])
+        out.seek(0)
+        self.assertEquals(out.read(), 'foofoo')
+        self.assertFalse(f.closed)
+        f = weakref.ref(f)
+        del c
+        self.assertEquals(f(), None)
@@ -1,10 +1,42 @@
 import pdb
+import pickle
+import shutil
+import StringIO
 import time
 import os
+import subprocess
+import sys
 import tempfile
+import unittest
 from test_extproc.test_lib import ExtProcTest, STDIN, STDOUT, STDERR
+from convience import here
 from extproc import (
-    Sh, Pipe, Cmd, JOBS, fork_dec, InvalidArgsException, make_echoer)
+    Sh, Pipe, Cmd, JOBS, fork_dec, InvalidArgsException, make_echoer,
+    PythonProc, EXECUTABLES, ExecutableCache, CmdTemplate, _pipe_size,
+    _pipe_max_size, subreaper, Seq, And, Or, Graph, JobQueue, Coproc,
+    CoprocPool, CoprocError, trace, CAPTURES, In, Out, CLOSE, PROFILES)
+
+class _Unloadable(object):
+    def __reduce__(self):
+        return _unload, ()
+
+def _unload():
+    raise ValueError("cannot be rebuilt")
+
+def _group_members(pgid):
+    """
+    The live processes of group 'pgid', with their parent pid.
+    """
+    members = {}
+    for name in os.listdir('/proc'):
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[2]) == pgid and fields[0] != 'Z':
+            members[int(name)] = int(fields[1])
+    return members
 
 class ExtProcPipeTest(ExtProcTest):
 
@@ -95,6 +127,67 @@ class ExtProcPipeTest(ExtProcTest):
         self.assertEquals(sleeper.returncode, 0)
 
 
+    def test_pipe_size(self):
+        yes = Pipe(Cmd('yes'), Cmd('sleep 0.5'), Cmd('sleep 0.5'),
+                   pipe_size=['auto', 1 << 18]).spawn()
+        try:
+            self.assertEquals(
+                _pipe_size(yes.cmds[1].running_fd_objs[STDOUT]), 1 << 18)
+            ## 'sleep' does not read, so 'yes' fills the link, which grows
+            time.sleep(0.3)
+            self.assertEquals(
+                _pipe_size(yes.cmds[0].running_fd_objs[STDOUT]),
+                _pipe_max_size())
+        finally:
+            yes.kill()
+        self.assertRaises(
+            ValueError, lambda: Pipe(Cmd('yes'), Cmd('true'), pipe_size=[]))
+        ## one value per link between the stages given, fused or not
+        stages = lambda: (Sh('echo foo'), PythonProc(list, objects=True),
+                          PythonProc(list, objects=True), Cmd('cat'))
+        sizes = [1 << 16, 1 << 17, 1 << 18]
+        self.assertEquals(Pipe(*stages(), pipe_size=sizes).pipe_sizes, sizes)
+        self.assertEquals(
+            Pipe(*stages(), pipe_size=sizes, fuse=True).pipe_sizes,
+            [1 << 16, 1 << 18])
+        self.assertRaises(
+            ValueError,
+            lambda: Pipe(*stages(), pipe_size=sizes[:2], fuse=True))
+        self.assertSh(
+            Pipe(Cmd('yes'), Cmd('head -n 2'),
+                 pipe_size='auto').capture().stdout.read(), 'yy')
+
+    def test_metrics(self):
+        def producer(stdin, stdout, stderr):
+            stdout.write('x' * 100000)
+            stdout.flush()
+            ## 'cat' waits for the input for about 0.4s after 'sleep'
+            time.sleep(0.6)
+
+        reports = []
+        pipe_obj = Pipe(PythonProc(producer), Cmd('cat'),
+                        Sh('sleep 0.2; cat'), Cmd('wc -c'),
+                        on_metrics=reports.append, metrics_interval=0.05)
+        self.assertEquals(pipe_obj.metrics(), None)
+        self.assertEquals(pipe_obj.run(), 0)
+        self.assertEquals(pipe_obj.returncodes, [0, 0, 0, 0])
+        metrics = pipe_obj.metrics()
+        self.assertTrue(len(reports) >= 3, reports)
+        self.assertEquals(metrics, reports[-1])
+        self.assertTrue(metrics['links'][0]['written'] >= 100000, metrics)
+        self.assertTrue(metrics['elapsed'] >= 0.2)
+        self.assertEquals(
+            [s['pid'] for s in metrics['stages']],
+            [c.p.pid for c in pipe_obj.cmds])
+        ## 'cat' waited for the producer, and for 'sleep' to be over
+        self.assertTrue(metrics['stages'][1]['blocked_read'] > 0.1, metrics)
+        self.assertTrue(metrics['stages'][1]['blocked_write'] > 0.1, metrics)
+
+        ## 'head' exits early: 'yes' must get EPIPE in spite of the monitor
+        pipe_obj = Pipe(Cmd('yes'), Cmd('head -n 1'), monitor=True)
+        pipe_obj.run()
+        self.assertEquals(pipe_obj.returncodes[1], 0)
+
     def chriss_recommended_syntax(self):
         '''
         ls().pipe_to(grep("pyc")).pipe_to(...)
@@ -138,6 +231,69 @@ class ExtProcPipeTest(ExtProcTest):
         self.assertSh(
             cmd.capture(1, timeout=1).stdout.read(), '')
 
+    def test_trace(self):
+        import json
+        tracer = trace()
+        try:
+            p = Pipe(Cmd('seq 1 3'), Sh('cat; exit 4'))
+            p.capture(limit=100)
+            job = Cmd('sleep 5')
+            job.spawn()
+        finally:
+            self.assertTrue(trace(False) is tracer)
+        job.kill()
+        job.wait()
+        Cmd('true').run()
+
+        f = tempfile.TemporaryFile()
+        tracer.export(f)
+        f.seek(0)
+        events = json.load(f)['traceEvents']
+        lifetimes = dict((e['args']['pid'], e) for e in events
+                         if e['ph'] == 'X' and e['name'] != 'fork/exec')
+        seq, cat = [c.p.pid for c in p.cmds]
+        self.assertEquals(sorted(lifetimes), sorted([seq, cat, job.p.pid]))
+        self.assertEquals(lifetimes[seq]['args']['argv'], ['seq', '1', '3'])
+        self.assertEquals(lifetimes[cat]['args']['pipeline'],
+                          "seq 1 3 | /bin/sh -c cat; exit 4")
+        self.assertEquals(lifetimes[cat]['args']['exit_status'], 4)
+        self.assertEquals(lifetimes[job.p.pid]['args']['exit_status'], -9)
+        outputs = [e['tid'] for e in events if e['ph'] == 'i']
+        self.assertEquals(outputs, [cat])
+        for e in events:
+            if e['ph'] == 'X':
+                self.assertTrue(e['dur'] >= 0)
+
+    def test_pgroup(self):
+        ## without a process group, the orphaned sleep would keep the
+        ## capture pipe open for 30s
+        start = time.time()
+        c = Sh('sleep 30 & echo $!; wait', pgroup=True).capture(
+            timeout=0.5, limit=100)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(c.exit_status, -9)
+        time.sleep(0.1)
+        self.assertEquals(_group_members(int(c.stdout.read())), {})
+
+        pipe_obj = Pipe(Sh('sleep 30 & sleep 30'), Cmd('cat'), pgroup=True)
+        pipe_obj.spawn()
+        self.assertEquals(
+            [os.getpgid(c.p.pid) for c in pipe_obj.cmds], [pipe_obj.pgid] * 2)
+        time.sleep(0.1)
+        self.assertEquals(len(_group_members(pipe_obj.pgid)), 4)
+        subreaper()
+        try:
+            pipe_obj.kill()
+            ## kill() waited for the stages
+            self.assertEquals(pipe_obj.returncodes, [-9, -9])
+            pipe_obj.wait()
+            ## the orphaned sleep was reparented to us, and reaped
+            self.assertEquals(_group_members(pipe_obj.pgid), {})
+            self.assertRaises(OSError, lambda: os.waitpid(-pipe_obj.pgid,
+                                                          os.WNOHANG))
+        finally:
+            subreaper(False)
+
     def test_capture_timeout2(self):
         """ make sure that a timeout that is longer than a pipeline
         should take to execute doesn't alter the results of that
@@ -153,6 +309,11 @@ class ExtProcPipeTest(ExtProcTest):
             p.capture(1, timeout=1).stdout.read(),
             'y\ny\ny\ny\ny\ny\ny\ny\ny\ny\n')
 
+        ## a stage outliving the last one is killed and waited for
+        p = Pipe(Cmd('sleep 30'), Cmd('true'))
+        self.assertEquals(p.capture().exit_status, 0)
+        self.assertEquals(p.returncodes, [-9, 0])
+
 
 class ExtProcCmdTest(ExtProcTest):
     def test_CMD(self):
@@ -210,12 +371,623 @@ class ExtProcCmdTest(ExtProcTest):
         self.assertRaises(Exception, lambda: ab.spawn())
 
 
+    def test_executable_cache(self):
+        self.assertRaises(OSError, lambda: Cmd('no-such-command-here'))
+        hits = EXECUTABLES.stats['hits']
+        self.assertEquals(Cmd('cat').executable, Cmd('cat').executable)
+        self.assertTrue(EXECUTABLES.stats['hits'] > hits)
+
+        d = tempfile.mkdtemp()
+        foo = os.path.join(d, 'foo')
+        try:
+            cache = ExecutableCache(ttl=0)
+            self.assertRaises(OSError, lambda: cache.resolve('foo', d))
+            with open(foo, 'w') as f:
+                f.write('#!/bin/sh\necho foo\n')
+            os.chmod(foo, 0755)
+            ## the directory changed
+            self.assertEquals(cache.resolve('foo', d), foo)
+            self.assertEquals(cache.resolve('foo', d), foo)
+            self.assertEquals(cache.stats['hits'], 1)
+            self.assertSh(
+                Cmd('foo', e={'PATH': d}).capture().stdout.read(), 'foo')
+            self.assertSh(
+                Pipe(Cmd('echo bar'), Sh('foo; cat'), e={'PATH': d + ':' +
+                    os.environ['PATH']}).capture().stdout.read(), 'foobar')
+            ## looked up again in the PATH of its pipeline or chain
+            other = os.path.join(d, 'other')
+            os.mkdir(other)
+            with open(os.path.join(other, 'foo'), 'w') as f:
+                f.write('#!/bin/sh\necho other\n')
+            os.chmod(os.path.join(other, 'foo'), 0755)
+            self.assertSh(
+                Pipe(Cmd('foo', e={'PATH': other}), Cmd('cat'),
+                     e={'PATH': d + ':' + os.environ['PATH']}).capture(
+                         ).stdout.read(), 'foo')
+            self.assertSh(
+                Seq(Cmd('foo', e={'PATH': d}), e={'PATH': other}).capture(
+                    ).stdout.read(), 'other')
+            ## a cached binary that is no longer executable
+            cache = ExecutableCache(ttl=60)
+            self.assertEquals(cache.resolve('foo', d), foo)
+            os.chmod(foo, 0644)
+            self.assertRaises(OSError, lambda: cache.resolve('foo', d))
+            self.assertEquals(
+                cache.resolve('foo', d + ':' + other),
+                os.path.join(other, 'foo'))
+            os.remove(foo)
+            cache.refresh()
+            self.assertRaises(OSError, lambda: cache.resolve('foo', d))
+        finally:
+            shutil.rmtree(d)
+
+    def test_template(self):
+        echo = CmdTemplate(['echo', '{greeting},', 'x{name}x'])
+        self.assertEquals(
+            echo(greeting='hello', name='; rm -rf / #'),
+            Cmd(['echo', 'hello,', 'x; rm -rf / #x']))
+        self.assertSh(
+            echo(greeting='hi', name='$HOME').capture().stdout.read(),
+            'hi, x$HOMEx')
+        self.assertRaises(TypeError, lambda: echo(greeting='hi'))
+        self.assertRaises(
+            TypeError, lambda: echo(greeting='hi', name='', extra=''))
+
+        ## the Cmds of a template share no containers
+        a, b = echo(greeting='a', name='a'), echo(greeting='b', name='b')
+        a.cmd.append('x')
+        a.e['X'] = a.env['X'] = '1'
+        a.fd_objs[STDOUT] = os.devnull
+        self.assertEquals(b, Cmd(['echo', 'b,', 'xbx']))
+        self.assertEquals((b.e, echo.prototype.e), ({}, {}))
+
+        cat = CmdTemplate('cat {f}', {STDOUT: os.devnull})
+        jobs = [cat.spawn(f='/dev/null') for i in range(3)]
+        self.assertEquals([c.wait() for c in jobs], [0, 0, 0])
+
+        self.assertRaises(ValueError, lambda: CmdTemplate('{prog} foo'))
+        self.assertRaises(ValueError, lambda: CmdTemplate('cat {f.name}'))
+        self.assertRaises(ValueError, lambda: CmdTemplate('cat {0}'))
+        self.assertRaises(OSError, lambda: CmdTemplate('no-such-command {f}'))
+
+    def test_close_fds(self):
+        f = tempfile.TemporaryFile()
+        redirect = 'echo foo >&%d' % f.fileno()
+        self.assertNotEquals(Sh(redirect, {STDERR: os.devnull}).run(), 0)
+        self.assertEquals(Sh(redirect, keep_fds=[f.fileno()]).run(), 0)
+        f.seek(0)
+        self.assertSh(f.read(), 'foo')
+
+        def writer(stdin, stdout, stderr):
+            os.write(f.fileno(), 'bar')
+        self.assertRaises(OSError, lambda: PythonProc(writer).run())
+        PythonProc(writer, keep_fds=[f.fileno()]).run()
+        f.seek(0)
+        self.assertSh(f.read(), 'foo\nbar')
+
+    def test_capture_limit(self):
+        digits = Sh('seq 1 100000; seq 1 3 >&2')
+        out, err, status = digits.capture(1, 2, limit=6, keep='both')
+        self.assertEquals(out.read(), '1\n2' + '00\n')
+        self.assertEquals(err.read(), '1\n2\n3\n')
+        self.assertEquals(status, 0)
+        total = len(''.join('%d\n' % i for i in range(1, 100001)))
+        c = Sh('seq 1 100000').capture(limit=4, keep='head')
+        self.assertEquals(c.stdout.read(), '1\n2\n')
+        self.assertEquals(c.dropped, {1: total - 4})
+        c = Pipe(Cmd('yes'), Cmd('head -c 1000000'), Cmd('cat')).capture(
+            limit=4)
+        self.assertEquals((c.stdout.read(), c.dropped), ('y\ny\n', {1: 999996}))
+        self.assertRaises(ValueError, lambda: Cmd('true').capture(keep='x',
+                                                                  limit=1))
+
+        ## the capture pipes of a child that could not be spawned are closed
+        fds = len(os.listdir('/proc/self/fd'))
+        for job in (Cmd('true', cd='/no/such/dir'),
+                    Pipe(Cmd('true'), Cmd('cat', cd='/no/such/dir'))):
+            for kwargs in (dict(limit=4), dict(compress='zlib')):
+                self.assertRaises(OSError,
+                                  lambda: job.capture(1, 2, **kwargs))
+        self.assertEquals(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_capture_compress(self):
+        numbers = ''.join('%d\n' % i for i in range(1, 100001))
+        for codec in ('zlib', 'gzip'):
+            out = Sh('seq 1 100000').capture(compress=codec).stdout
+            self.assertEquals(out.stats['raw_size'], len(numbers))
+            self.assertTrue(out.stats['ratio'] > 2)
+            self.assertEquals(out.readline(), '1\n')
+            self.assertEquals(out.read(4), '2\n3\n')
+            self.assertEquals(out.read(), numbers[6:])
+            out.seek(2)
+            self.assertEquals(list(out)[:2], ['2\n', '3\n'])
+            out.seek(0)
+            self.assertEquals(out.readline(1), '1')
+            self.assertEquals(out.readline(), '\n')
+            ## lines across decompressed chunks, read in small pieces
+            out.seek(0)
+            out.chunk_size = 7
+            self.assertEquals(''.join(iter(lambda: out.read(3), '')), numbers)
+            out.seek(0)
+            self.assertEquals(len(out.readlines()), 100000)
+            out.close()
+        c = Pipe(Sh('echo foo; echo bar >&2'), Cmd('cat')).capture(
+            1, 2, compress='gzip')
+        self.assertEquals((c.stdout.read(), c.stderr.read()),
+                          ('foo\n', 'bar\n'))
+        self.assertRaises(ValueError,
+                          lambda: Cmd('true').capture(compress='rar'))
+        self.assertRaises(ValueError,
+                          lambda: Cmd('true').capture(limit=1, compress='zlib'))
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                self.assertRaises(
+                    ValueError, lambda: Cmd('true').capture(compress='lzma'))
+
+    def test_capture_lines(self):
+        c = Sh('seq 1 100000').capture()
+        numbers = c.stdout.read().splitlines()
+        lines = c.lines
+        self.assertTrue(lines is c.lines)
+        self.assertEquals(len(lines), 100000)
+        self.assertEquals((lines[0], lines[99], lines[-1]),
+                          ('1', '100', '100000'))
+        self.assertEquals(list(lines[10:1000:7]), numbers[10:1000:7])
+        self.assertEquals(list(lines[::-1][5:9]), numbers[::-1][5:9])
+        self.assertEquals(list(reversed(lines[3:8])), numbers[3:8][::-1])
+        self.assertEquals(len(lines[50:10]), 0)
+        self.assertRaises(IndexError, lambda: lines[100000])
+        self.assertEquals(list(Sh('printf "a\\n\\nb"').capture().lines),
+                          ['a', '', 'b'])
+        self.assertEquals(len(Cmd('true').capture().lines), 0)
+        self.assertRaises(ValueError, lambda: Cmd('true').capture(2).lines)
+        self.assertEquals(
+            list(Sh('seq 1 3').capture(compress='zlib').lines), numbers[:3])
+
+        ## closing the capture unmaps its file
+        c.close()
+        self.assertRaises(ValueError, lambda: lines[0])
+        with Sh('seq 1 3').capture() as c:
+            lines = c.lines[1:]
+            self.assertEquals(lines[0], '2')
+        self.assertRaises(ValueError, lambda: lines[0])
+
+    def test_capture_lifecycle(self):
+        log = tempfile.TemporaryFile()
+        with Sh('echo foo; echo bar >&2', {STDERR: log}).capture() as c:
+            self.assertTrue(c.stdout in CAPTURES.buffers())
+            self.assertTrue(CAPTURES.size() >= 4)
+            self.assertEquals(c.stdout.read(), 'foo\n')
+        self.assertTrue(c.stdout.closed)
+        self.assertFalse(c.stdout in CAPTURES.buffers())
+        ## not ours
+        self.assertFalse(log.closed)
+
+        with Cmd('seq 1 3').capture(limit=4, keep='head') as c:
+            self.assertEquals(c.stdout.read(), '1\n2\n')
+        self.assertTrue(c.stdout.closed)
+
+        with Pipe(Cmd('yes'), Cmd('cat')).capture_spawn() as live:
+            self.assertEquals(live.returncode, None)
+        self.assertNotEquals(live.returncode, None)
+        self.assertTrue(live.pipe_obj.fd_objs[STDOUT].closed)
+
+    def test_capture_budget(self):
+        kept = Cmd('echo foo').capture()
+        CAPTURES.budget = CAPTURES.size() + 1000
+        try:
+            c = Cmd('seq 1 1000').capture()
+            numbers = ''.join('%d\n' % i for i in range(1, 1001))
+            self.assertEquals(c.stdout.read(), numbers[:1000])
+            self.assertEquals(c.dropped, {1: len(numbers) - 1000})
+            ## while the first capture takes the whole budget
+            full = Sh('echo bar >&2').capture(2)
+            self.assertEquals((full.stderr.read(), full.dropped), ('', {2: 4}))
+            full.close()
+            c.close()
+            with Cmd('echo foo').capture() as c:
+                self.assertEquals(c.stdout.read(), 'foo\n')
+                self.assertEquals(c.dropped, {1: 0})
+
+            ## within the budget, the running total does without size()
+            CAPTURES.budget = CAPTURES.size() + (1 << 20)
+            sizes = []
+            CAPTURES.size = lambda: sizes.append(1) or 0
+            try:
+                with Sh('seq 1 100000').capture() as c:
+                    self.assertEquals(c.dropped, {1: 0})
+            finally:
+                del CAPTURES.size
+            self.assertEquals(sizes, [])
+        finally:
+            CAPTURES.budget = None
+        kept.close()
+
+    def test_substitution(self):
+        diff = Cmd(['diff', In(Pipe(Cmd('seq 1 3'), Cmd('tac'))),
+                    In(Sh('seq 3 -1 1; exit 3'))])
+        self.assertEquals(diff.capture().exit_status, 0)
+        self.assertEquals([arg.returncode for arg in diff.cmd[1:]], [0, 3])
+
+        ## the producers run at the same time: each waits for the other
+        fifo_dir = tempfile.mkdtemp()
+        fifo = os.path.join(fifo_dir, 'fifo')
+        os.mkfifo(fifo)
+        try:
+            paste = Cmd(['paste', In(Sh('echo a; cat %s' % fifo)),
+                         In(Sh('echo b >%s; echo c' % fifo))])
+            self.assertEquals(paste.capture().stdout.read(), 'a\tc\nb\t\n')
+        finally:
+            os.unlink(fifo)
+            os.rmdir(fifo_dir)
+
+        out = tempfile.TemporaryFile()
+        tee = Cmd(['tee', Out(Cmd('wc -l', {STDOUT: out}))],
+                  {STDIN: os.devnull, STDOUT: os.devnull})
+        tee.spawn()
+        self.assertEquals(tee.wait(), 0)
+        out.seek(0)
+        self.assertEquals(out.read().strip(), '0')
+
+        self.assertRaises(ValueError, lambda: In(Cmd('true', {STDOUT: out})))
+        self.assertEquals(str(In('seq 1 3')), '<(seq 1 3)')
+
+        ## the jobs already spawned for a command that failed are killed
+        fds = len(os.listdir('/proc/self/fd'))
+        start = time.time()
+        sleepers = [In('sleep 30'), In(Pipe(Cmd('sleep 30'), Cmd('cat')))]
+        cat = Cmd(['cat'] + sleepers, cd='/no/such/dir')
+        self.assertRaises(OSError, cat.run)
+        sleepers.append(In('sleep 30'))
+        cat = Cmd(['cat', sleepers[-1], In(Cmd('true', cd='/no/such/dir'))])
+        self.assertRaises(OSError, cat.run)
+        self.assertEquals([arg.returncode for arg in sleepers], [-9, -9, -9])
+        self.assertTrue(time.time() - start < 10)
+        self.assertEquals(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_fd_redirection(self):
+        self.assertEquals(
+            Sh('echo foo; echo bar >&2', {1: 2}).capture(2).stderr.read(),
+            'foo\nbar\n')
+        self.assertEquals(
+            Sh('(echo foo) 2>/dev/null || echo closed >&2',
+               {1: CLOSE}).capture(2).stderr.read(),
+            'closed\n')
+
+        ## to a file, a parent's fd passed through, and a copy of stdout
+        f = tempfile.TemporaryFile()
+        Sh('echo foo >&5; echo bar >&6', {5: f, 6: f.fileno()}).run()
+        f.seek(0)
+        self.assertEquals(f.read(), 'foo\nbar\n')
+        self.assertEquals(
+            Sh('echo foo >&3', {3: 1}).capture(1).stdout.read(), 'foo\n')
+        ## swapped fds
+        f, g = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        a, b = f.fileno(), g.fileno()
+        PythonProc(lambda i, o, e: (os.write(a, 'foo\n'), os.write(b, 'bar\n')),
+                   {a: b, b: a}).run()
+        f.seek(0)
+        g.seek(0)
+        self.assertEquals((f.read(), g.read()), ('bar\n', 'foo\n'))
+        self.assertRaises(ValueError, lambda: Cmd('true', {3: -1}))
+
+        ## side channels next to stdout, of all the stages of a pipeline
+        c = Sh('echo data; echo progress >&3').capture(1, 3)
+        self.assertEquals((c.stdout.read(), c.fds[3].read()),
+                          ('data\n', 'progress\n'))
+        c = Pipe(Sh('echo a >&3; echo x'), Sh('cat; echo b >&3'),
+                 PythonProc(lambda i, o, e: (i.read(), os.write(3, 'c\n')))
+                 ).capture(3)
+        self.assertEquals(sorted(c.fds[3].read().split()), ['a', 'b', 'c'])
+        ## fds above any open in the parent
+        f = tempfile.TemporaryFile()
+        write = 'import os; os.write(50, "foo")'
+        self.assertEquals(Cmd([sys.executable, '-c', write], {50: f}).run(), 0)
+        f.seek(0)
+        self.assertEquals(f.read(), 'foo')
+        self.assertEquals(
+            Cmd([sys.executable, '-c', write]).capture(50).fds[50].read(),
+            'foo')
+        ## the lowest free fds, which the error pipe of Popen would get
+        r, w = os.pipe()
+        os.close(r)
+        os.close(w)
+        f = tempfile.TemporaryFile()
+        self.assertRaises(OSError, Cmd('/no/such/command', {r: f, w: f}).run)
+        f.seek(0)
+        self.assertEquals(f.read(), '')
+
+        c = Sh('seq 1 1000 >&3').capture(3, limit=9)
+        self.assertEquals((c.fds[3].read(), c.dropped), ('999\n1000\n', {3: 3884}))
+        c.close()
+        self.assertTrue(c.fds[3].closed)
+        self.assertRaises(
+            ValueError, lambda: Sh('true', {3: os.devnull}).capture(3))
+        self.assertRaises(ValueError, lambda: Sh('true').capture(0))
+
+    def test_spawn_callbacks(self):
+        got = []
+        c = Sh('seq 1 5; echo err >&2; printf tail')
+        c.spawn(on_stdout=lambda lines: got.append(('out', lines)),
+                on_stderr=lambda lines: got.append(('err', lines)),
+                batch_lines=2)
+        self.assertEquals(c.wait(), 0)
+        self.assertEquals([l for n, l in got if n == 'out'],
+                          [['1', '2'], ['3', '4'], ['5', 'tail']])
+        self.assertEquals([l for n, l in got if n == 'err'], [['err']])
+
+        got = []
+        p = Pipe(Sh('echo a; echo b >&2'), Cmd('cat'))
+        p.spawn(on_stdout=got.extend, on_stderr=got.extend)
+        self.assertEquals(p.wait(), 0)
+        self.assertEquals(sorted(got), ['a', 'b'])
+
+        def fail(lines):
+            got.append(lines)
+            raise KeyError('bogus')
+        got = []
+        c = Cmd('seq 1 10')
+        c.spawn(on_stdout=fail, batch_lines=1)
+        self.assertRaises(KeyError, c.wait)
+        self.assertEquals((got, c.returncode), ([['1']], 0))
+
+        self.assertRaises(
+            ValueError,
+            lambda: Cmd('true', {STDOUT: os.devnull}).spawn(on_stdout=id))
+
+        ## the followed pipes of a child that could not be spawned are closed
+        fds = len(os.listdir('/proc/self/fd'))
+        for job in (Cmd('true', cd='/no/such/dir'),
+                    Pipe(Cmd('true'), Cmd('cat', cd='/no/such/dir'))):
+            self.assertRaises(
+                OSError, lambda: job.spawn(on_stdout=len, on_stderr=len))
+        self.assertRaises(
+            ValueError, lambda: Cmd('true', {STDERR: os.devnull}).spawn(
+                on_stdout=len, on_stderr=len))
+        self.assertEquals(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_python_result(self):
+        def summer(stdin, stdout, stderr):
+            stdout.write('summing\n')
+            return sum(int(line) for line in stdin)
+        proc = PythonProc(
+            summer, {STDIN: here('1\n2\n3\n'), STDOUT: os.devnull})
+        proc.spawn()
+        self.assertEquals(proc.result, 6)
+        self.assertEquals(proc.wait(), 0)
+
+        out, err, status = Pipe(Sh('seq 1 10'), PythonProc(summer)).capture(1)
+        self.assertSh(out.read(), 'summing')
+        self.assertEquals(status, 0)
+        self.assertEquals(
+            Pipe(Sh('seq 1 10'), PythonProc(summer)).capture(1).result, 55)
+
+        ## results larger than any pipe buffer are streamed
+        big = PythonProc(lambda i, o, e: {'data': 'x' * (3 << 20)})
+        self.assertEquals(len(big.capture().result['data']), 3 << 20)
+
+        ## and read while the child is polled, not only waited for
+        def big_result(stdin, stdout, stderr):
+            stdin.read()
+            return 'x' * (1 << 20)
+        graph = Graph()
+        graph.add(PythonProc(big_result, {STDIN: os.devnull}))
+        self.assertEquals(graph.run(), 0)
+        queue = JobQueue()
+        queue.submit(PythonProc(big_result, {STDIN: os.devnull}))
+        self.assertEquals(queue.run(), 0)
+        stage = PythonProc(big_result)
+        pipe_obj = Pipe(Sh('echo foo'), stage, Cmd('cat'))
+        pipe_obj.capture()
+        self.assertEquals(pipe_obj.returncodes, [0, 0, 0])
+        self.assertEquals(len(stage.result), 1 << 20)
+
+        def failer(stdin, stdout, stderr):
+            raise KeyError('bogus')
+        self.assertRaises(KeyError, lambda: PythonProc(failer).capture())
+
+        ## a result that cannot be unpickled here
+        proc = PythonProc(lambda i, o, e: _Unloadable())
+        self.assertEquals(proc.capture().result, None)
+        self.assertTrue(isinstance(proc.p.result_error, ValueError))
+
+        ## nor pickled in the child, which has run fine all the same
+        proc = PythonProc(lambda i, o, e: (x for x in [1]))
+        capture = proc.capture()
+        self.assertEquals(capture.exit_status, 0)
+        self.assertEquals(capture.result, None)
+        self.assertTrue(
+            isinstance(proc.p.result_error, pickle.PicklingError))
+
+    def test_fds_above_fd_setsize(self):
+        ## the parent's fds of a long-running service may be numbered
+        ## beyond what select() can watch
+        fds = []
+        try:
+            while not fds or fds[-1] < 1100:
+                try:
+                    fds.append(os.dup(0))
+                except OSError:
+                    self.skipTest("too few fds allowed")
+            self.assertEquals(
+                PythonProc(lambda i, o, e: 42).capture().result, 42)
+            self.assertEquals(
+                Sh('echo foo').capture(limit=2).stdout.read(), 'o\n')
+            self.assertEquals(
+                Sh('echo foo').capture(compress='zlib').stdout.read(),
+                'foo\n')
+        finally:
+            for fd in fds:
+                os.close(fd)
+
     def _test_popen_fd_semantics(self):
         tf = tempfile.TemporaryFile()
         ab = Cmd('yes', {STDOUT: tf})
         ab._popen()
         self.assertTrue(tf is ab.fd_objs[STDOUT])
 
+class PythonProcTest(ExtProcTest):
+    def test_object_stream(self):
+        def parse(records):
+            for line in records:
+                yield (int(line), line.strip())
+
+        def double(records):
+            for n, text in records:
+                yield n * 2
+
+        pipe_obj = Pipe(Sh('seq 1 5'),
+                        PythonProc(parse, objects=True),
+                        PythonProc(double, objects=True, codec='marshal'),
+                        Cmd('cat'))
+        self.assertEquals(
+            pipe_obj.capture().stdout.read(), '2\n4\n6\n8\n10\n')
+        self.assertEquals(
+            [getattr(c, 'framed_out', False) for c in pipe_obj.cmds],
+            [False, True, False, False])
+        self.assertEquals(
+            [getattr(c, 'framed_in', None) for c in pipe_obj.cmds],
+            [None, None, 'pickle', None])
+
+        ## every record is written as one line
+        self.assertEquals(
+            PythonProc(lambda records: ['a', 'b\n', 1, (2, '\n')],
+                       objects=True).capture().stdout.read(),
+            "a\nb\n1\n(2, '\\n')\n")
+
+        ## more records than a pipe buffer holds
+        self.assertSh(
+            Pipe(Sh('seq 1 100000'),
+                 PythonProc(parse, objects=True, batch_size=100),
+                 PythonProc(double, objects=True),
+                 Cmd('tail -n 1')).capture().stdout.read(),
+            '200000')
+
+    def test_fuse(self):
+        def pid_of(records):
+            for record in records:
+                yield '%s %d\n' % (record.strip(), os.getpid())
+        def upper(records):
+            for record in records:
+                yield record.upper()
+
+        pipe_obj = Pipe(Sh('echo foo; echo bar'),
+                        PythonProc(upper, objects=True),
+                        PythonProc(pid_of, objects=True),
+                        PythonProc(pid_of, objects=True),
+                        Cmd('cat'),
+                        fuse=True)
+        self.assertEquals(len(pipe_obj.cmds), 3)
+        lines = [l.split() for l in
+                 pipe_obj.capture().stdout.read().splitlines()]
+        self.assertEquals([l[0] for l in lines], ['FOO', 'BAR'])
+        ## both pid_of stages ran in the same child
+        self.assertEquals(lines[0][1], lines[0][2])
+        self.assertEquals(pipe_obj.returncodes, [0, 0, 0, 0, 0])
+
+        ## fused stages share the exit status of their child
+        def bail(records):
+            os._exit(3)
+        pipe_obj = Pipe(Sh('echo foo'),
+                        PythonProc(upper, objects=True),
+                        PythonProc(bail, objects=True),
+                        Cmd('cat'),
+                        fuse=True)
+        pipe_obj.capture()
+        self.assertEquals(pipe_obj.returncodes, [0, 3, 3, 0])
+
+        ## stages with different stderr are not fused
+        pipe_obj = Pipe(Sh('echo foo'),
+                        PythonProc(upper, objects=True),
+                        PythonProc(upper, {STDERR: os.devnull}, objects=True),
+                        fuse=True)
+        self.assertEquals(len(pipe_obj.cmds), 3)
+        self.assertSh(pipe_obj.capture().stdout.read(), 'FOO')
+
+        ## nor those with their own process group or fds >= 3
+        def note(records):
+            for record in records:
+                os.write(3, 'noted\n')
+                yield record
+        f = tempfile.TemporaryFile()
+        pipe_obj = Pipe(Sh('echo foo'),
+                        PythonProc(upper, objects=True),
+                        PythonProc(note, {3: f}, objects=True),
+                        PythonProc(upper, objects=True, pgroup=True),
+                        fuse=True)
+        self.assertEquals(len(pipe_obj.cmds), 4)
+        self.assertSh(pipe_obj.capture().stdout.read(), 'FOO')
+        f.seek(0)
+        self.assertSh(f.read(), 'noted')
+
+    def test_thread_mode(self):
+        seen = []
+        def upper(stdin, stdout, stderr):
+            for line in stdin:
+                seen.append(line)
+                stdout.write(line.upper())
+            return len(seen)
+
+        stage = PythonProc(upper, mode='thread')
+        pipe_obj = Pipe(Sh('echo foo; echo bar'), stage, Cmd('sort'))
+        self.assertEquals(pipe_obj.capture().stdout.read(), 'BAR\nFOO\n')
+        ## the function ran in this process
+        self.assertEquals(seen, ['foo\n', 'bar\n'])
+        self.assertEquals(stage.p.pid, None)
+        self.assertEquals(stage.result, 2)
+        self.assertEquals(pipe_obj.returncodes, [0, 0, 0])
+
+        def failer(stdin, stdout, stderr):
+            raise KeyError('bogus')
+        stage = PythonProc(failer, mode='thread')
+        self.assertEquals(stage.capture().exit_status, 1)
+        self.assertTrue(isinstance(stage.p.exception, KeyError))
+
+        def double(records):
+            for record in records:
+                yield int(record) * 2
+        self.assertSh(
+            Pipe(Sh('echo 21'),
+                 PythonProc(double, objects=True, mode='thread'),
+                 PythonProc(double, objects=True)).capture().stdout.read(),
+            '84')
+
+    def test_profile(self):
+        def work(records):
+            for record in records:
+                yield ' '.join(sorted(record.split())) + '\n'
+        def fail(stdin, stdout, stderr):
+            sorted(range(10))
+            raise KeyError('bogus')
+
+        PROFILES.clear()
+        self.assertEquals(PROFILES.stats(), None)
+        pipe_obj = Pipe(Sh('echo b a; echo d c'),
+                        PythonProc(work, objects=True, profile=True),
+                        PythonProc(work, objects=True, profile=True),
+                        Cmd('cat'))
+        self.assertEquals(pipe_obj.capture().stdout.read(), 'a b\nc d\n')
+        self.assertRaises(
+            KeyError, lambda: PythonProc(fail, profile=True).capture())
+        ## both stages, and the profile up to the exception
+        self.assertEquals(PROFILES.runs, 3)
+        stats = PROFILES.stats(stream=StringIO.StringIO())
+        calls = dict((func[2], stat[1])
+                     for func, stat in stats.stats.iteritems())
+        self.assertTrue('work' in calls)
+        self.assertEquals(calls['fail'], 1)
+        self.assertEquals(calls['<sorted>'], 5)
+        PROFILES.clear()
+        self.assertEquals(PROFILES.runs, 0)
+
+        self.assertRaises(
+            ValueError,
+            lambda: PythonProc(fail, mode='thread', profile=True))
+
 class ExtPipeSyntaxtTest(ExtProcTest):
     def test_pipeto(self):
         self.assertSh(
@@ -256,3 +1028,245 @@ class ExtPipeSyntaxtTest(ExtProcTest):
 
         if __name__ == '__main__':
             unittest.main()
+
+class ChainTest(ExtProcTest):
+    def test_chains(self):
+        chain = And(Sh('echo foo'), Or(Cmd('false'), Sh('echo bar >&2')),
+                    Pipe(Sh('echo baz'), Cmd('tr a-z A-Z')))
+        out, err, status = chain.capture(1, 2)
+        self.assertEquals((out.read(), err.read(), status),
+                          ('foo\nBAZ\n', 'bar\n', 0))
+        self.assertEquals(chain.returncodes, [0, 0, 0])
+        self.assertEquals(chain.steps[1].returncodes, [1, 0])
+        self.assertTrue(all(t >= 0 for t in chain.times))
+
+        chain = And(Cmd('true'), Sh('exit 3'), Cmd('true'))
+        self.assertEquals(chain.run(), 3)
+        self.assertEquals(chain.returncodes, [0, 3, None])
+        self.assertEquals(chain.times[2], None)
+        chain = Or(Cmd('true'), Cmd('false'))
+        self.assertEquals((chain.run(), chain.returncodes), (0, [0, None]))
+        chain = Seq(Sh('exit 2'), Sh('exit 1'))
+        self.assertEquals((chain.run(), chain.returncodes), (1, [2, 1]))
+
+        ## steps keep their own redirections, and the chain is a stage
+        chain = Seq(Sh('echo foo'), Sh('echo bar', {1: os.devnull}),
+                    Cmd('cat'))
+        self.assertEquals(
+            Pipe(Sh('echo baz'), chain, Cmd('wc -l')).capture(
+                ).stdout.read().strip(), '2')
+
+    def test_chain_kill(self):
+        chain = Seq(Sh('sleep 5'), Sh('echo foo'))
+        start = time.time()
+        c = chain.capture(timeout=0.3)
+        self.assertTrue(time.time() - start < 3)
+        self.assertEquals((c.stdout.read(), c.exit_status), ('', -9))
+        self.assertEquals(chain.returncodes, [-9, None])
+
+        ## a nested chain skips its remaining steps too
+        inner = Seq(Sh('sleep 3'), Sh('echo inner'))
+        chain = Seq(inner, Sh('echo outer'))
+        start = time.time()
+        c = chain.capture(timeout=0.3)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEquals((c.stdout.read(), c.exit_status), ('', -9))
+        self.assertEquals(inner.returncodes, [-9, None])
+        self.assertEquals(chain.returncodes, [-9, None])
+
+    def test_chain_fds(self):
+        self.assertRaises(
+            ValueError, lambda: Seq(Cmd('true'), fd={3: os.devnull}))
+
+
+class GraphTest(ExtProcTest):
+    def test_graph(self):
+        import json
+        g = Graph(jobs=2)
+        sleeps = [g.add(Cmd('sleep 0.2'), name='s%d' % i) for i in range(4)]
+        g.add(Pipe(Sh('echo y'), Cmd('cat')), after=sleeps, name='yes')
+        self.assertEquals(g.run(), 0)
+        timings = json.loads(json.dumps(g.timings()))
+        starts = sorted(t['start'] for t in timings[:4])
+        ## two at a time
+        self.assertTrue(starts[2] - starts[0] > 0.15)
+        self.assertTrue(timings[4]['start'] >= max(t['end'] for t in timings[:4]))
+        self.assertEquals(timings[4]['after'], ['s0', 's1', 's2', 's3'])
+        self.assertEquals(g.returncodes['yes'], 0)
+
+        ## the job heading the longest path goes first
+        g = Graph(jobs=1)
+        short = g.add(Cmd('true'), name='short')
+        head = g.add(Cmd('true'), name='head')
+        g.add(Cmd('true'), after=[head], name='tail', cost=5)
+        g.run()
+        self.assertEquals(
+            [t['name'] for t in sorted(g.timings(), key=lambda t: t['start'])],
+            ['head', 'tail', 'short'])
+
+    def test_graph_failure(self):
+        def graph(keep_going):
+            g = Graph(jobs=1, keep_going=keep_going)
+            bad = g.add(Sh('exit 3'), name='bad', cost=10)
+            g.add(Cmd('true'), after=[bad], name='after bad')
+            g.add(Cmd('true'), name='other')
+            return g
+        g = graph(False)
+        self.assertEquals(g.run(), 3)
+        self.assertEquals([t['status'] for t in g.timings()],
+                          ['failed', 'skipped', 'skipped'])
+        g = graph(True)
+        self.assertEquals(g.run(), 3)
+        self.assertEquals([t['status'] for t in g.timings()],
+                          ['failed', 'skipped', 'done'])
+
+        g = Graph()
+        self.assertRaises(ValueError, lambda: g.add(Cmd('true'), after=['x']))
+
+
+class JobQueueTest(ExtProcTest):
+    def test_tokens(self):
+        q = JobQueue(dict(cpu=4, mem_mb=1000))
+        sorts = [q.submit(Cmd('sleep 0.2'), cpu=1, mem_mb=600)
+                 for i in range(2)]
+        xzs = [q.submit(Cmd('sleep 0.2'), cpu=1) for i in range(2)]
+        self.assertEquals(q.run(), 0)
+        first, second = q.jobs[:2]
+        ## the second sort waits for the memory of the first, the others
+        ## run along with the first
+        self.assertTrue(second.start >= first.end)
+        self.assertTrue(max(e.start for e in q.jobs[2:]) < first.end)
+        self.assertEquals(q.free, q.resources)
+        self.assertRaises(ValueError, lambda: q.submit(Cmd('true'), gpu=1))
+        self.assertRaises(ValueError, lambda: q.submit(Cmd('true'), cpu=5))
+
+    def test_order(self):
+        q = JobQueue(dict(cpu=1))
+        for name, priority, submitter in [('a1', 0, 'a'), ('a2', 0, 'a'),
+                                          ('a3', 0, 'a'), ('b1', 0, 'b'),
+                                          ('urgent', 1, 'c')]:
+            q.submit(Sh('exit 0', e={'NAME': name}), priority, submitter,
+                     cpu=1)
+        q.max_load = 0
+        self.assertEquals(q.poll(), 5)
+        self.assertEquals(q.free, dict(cpu=1))
+        q.max_load = None
+        self.assertEquals(q.run(), 0)
+        self.assertEquals(
+            [e.job.e['NAME'] for e in sorted(q.jobs, key=lambda e: e.start)],
+            ['urgent', 'a1', 'b1', 'a2', 'a3'])
+
+
+class CoprocTest(ExtProcTest):
+    def test_pipelined(self):
+        with Coproc(Sh('while read n; do seq 1 $n; echo .; done'),
+                    delimiter='.') as seq:
+            responses = [seq.submit(str(n)) for n in range(4)]
+            self.assertEquals([r.result(5) for r in responses],
+                              ['', '1', '1\n2', '1\n2\n3'])
+            self.assertEquals(seq.in_flight, 0)
+        self.assertRaises(CoprocError, lambda: seq.query('1'))
+
+        pair = Coproc(Sh('while read x; do echo $x; echo $x; done'), lines=2)
+        self.assertEquals(pair.query('a'), 'a\na')
+        self.assertEquals(pair.close(), 0)
+
+    def test_restart(self):
+        c = Coproc(Sh('while read x; do [ $x = die ] && exit 3; echo $x; done'))
+        self.assertEquals(c.query('a', 5), 'a')
+        self.assertRaises(CoprocError, lambda: c.query('die', 5))
+        self.assertEquals(c.query('b', 5), 'b')
+        self.assertEquals(c.restarts, 1)
+        self.assertEquals(c.close(), 0)
+
+        c = Coproc(Cmd('true'), restart=False)
+        self.assertRaises(CoprocError, lambda: c.query('a', 5))
+        self.assertRaises(CoprocError, lambda: c.query('a', 5))
+        self.assertEquals(c.close(), 0)
+
+    def test_pool(self):
+        with CoprocPool(Cmd('cat'), n=3) as pool:
+            words = [str(i) for i in range(100)]
+            self.assertEquals(pool.map(words, timeout=5), words)
+            pids = set(c._current.job.p.pid for c in pool.coprocs)
+            self.assertEquals(len(pids), 3)
+        self.assertEquals(pool.close(), [0, 0, 0])
+
+    def test_copies(self):
+        ## each coprocess runs a copy of the Cmd, sharing nothing with it
+        cmd = Cmd('cat', e={'FOO': 'bar'})
+        with CoprocPool(cmd, n=2) as pool:
+            self.assertEquals(pool.map(['a', 'b']), ['a', 'b'])
+            jobs = [c._current.job for c in pool.coprocs]
+        self.assertFalse(hasattr(cmd, 'p'))
+        self.assertEquals(cmd.fd_objs, {STDIN: 0, STDOUT: 1, STDERR: 2})
+        for job in jobs:
+            for name in ('env', 'e', 'fd_objs', 'cmd'):
+                self.assertFalse(getattr(job, name) is getattr(cmd, name))
+        self.assertFalse(jobs[0].env is jobs[1].env)
+
+        def echo(stdin, stdout, stderr):
+            for line in iter(stdin.readline, ''):
+                stdout.write(line)
+                stdout.flush()
+        with Coproc(PythonProc(echo)) as c:
+            self.assertEquals(c.query('x'), 'x')
+
+
+@unittest.skipUnless(os.environ.get('EXTPROC_SOAK'),
+                     'set EXTPROC_SOAK=1 to run the soak test')
+class SoakTest(ExtProcTest):
+    """
+    A short run of test_extproc/soak.py: nothing may leak.
+    """
+    def test_leaks(self):
+        from test_extproc.soak import soak
+        for name, entry in soak(50, warmup=5, checkpoints=1).iteritems():
+            leaks = entry['per_1000']
+            del leaks['rss_kb']
+            self.assertEquals(
+                [k for k, v in leaks.iteritems() if v > 0], [], (name, entry))
+
+
+@unittest.skipUnless(os.environ.get('EXTPROC_BENCH'),
+                     'set EXTPROC_BENCH=1 to run benchmarks')
+class PipeSizeBenchmark(ExtProcTest):
+    """
+    Throughput of a producer | relay | slow consumer pipeline with the
+    default 64 KiB pipes vs 1 MiB pipes.
+    """
+    size = 256 << 20
+
+    def bench(self, pipe_size):
+        pipe_obj = Pipe(
+            Cmd(['head', '-c', str(self.size), '/dev/zero']),
+            Cmd('cat'),
+            Cmd('dd bs=4096 of=/dev/null status=none'),
+            pipe_size=pipe_size)
+        t = time.time()
+        self.assertEquals(pipe_obj.run(), 0)
+        return (self.size >> 20) / (time.time() - t)
+
+    def test_throughput(self):
+        for pipe_size in [None, 1 << 20, 'auto']:
+            rate = max(self.bench(pipe_size) for i in range(3))
+            sys.stderr.write('\npipe_size=%s: %.0f MiB/s' % (pipe_size, rate))
+
+## Run in a fresh interpreter: list the modules loaded by importing extproc.
+_IMPORT_CHECK = """
+import sys
+import extproc
+print ' '.join(sorted(m for m in sys.modules if sys.modules[m] is not None))
+"""
+
+class ImportTimeTest(ExtProcTest):
+    def test_import_time(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        loaded = subprocess.Popen(
+            [sys.executable, '-c', _IMPORT_CHECK], cwd=root,
+            stdout=subprocess.PIPE).communicate()[0].split()
+        self.assertTrue('extproc' in loaded)
+        ## the old eager imports included these
+        for name in ('subprocess', 'tempfile', 'shlex', 'pickle', 'cPickle',
+                     'py_popen'):
+            self.assertFalse(name in loaded, name)
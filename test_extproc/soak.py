@@ -0,0 +1,229 @@
+"""
+Soak test: call each API of extproc many times over and report what it
+leaks per 1000 calls: open fds, zombie children, unlinked temp files,
+threads, JOBS entries and RSS.
+
+    python -m test_extproc.soak [--iterations N] [--json] [api ...]
+
+The JSON output is meant to be kept, to compare releases.
+"""
+import gc
+import os
+import subprocess
+import sys
+import time
+import tempfile
+import threading
+
+from extproc import Cmd, Sh, Pipe, Coproc, JOBS
+from convience import here
+
+
+def _open_fds():
+    return os.listdir('/proc/self/fd')
+
+def _temp_files():
+    """
+    The open fds of this process to files of the temp dir.
+    """
+    tmpdir = os.path.realpath(tempfile.gettempdir()) + os.sep
+    count = 0
+    for fd in _open_fds():
+        try:
+            if os.readlink('/proc/self/fd/%s' % fd).startswith(tmpdir):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+def _zombies():
+    """
+    The children of this process that have exited but were not waited.
+    """
+    me = str(os.getpid())
+    count = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue
+        fields = stat[stat.rindex(')') + 2:].split()
+        if fields[0] == 'Z' and fields[1] == me:
+            count += 1
+    return count
+
+def _rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def sample(settle=0.05):
+    """
+    Return the counters watched for leaks, after 'settle' seconds for
+    the children just killed to die and a collection of the garbage that
+    the next call would collect anyway: the children of the Popen
+    objects freed before they exited are only reaped by the next Popen.
+    """
+    time.sleep(settle)
+    gc.collect()
+    subprocess._cleanup()
+    return dict(fds=len(_open_fds()), zombies=_zombies(),
+                temp_files=_temp_files(), threads=threading.active_count(),
+                jobs=len(JOBS), rss_kb=_rss_kb())
+
+
+def _run():
+    Cmd('true').run()
+
+def _capture():
+    Cmd('echo foo').capture().stdout.read()
+
+def _capture_limit():
+    Sh('seq 1 1000').capture(limit=100).stdout.read()
+
+def _limit_failed():
+    try:
+        Cmd('true', cd='/no/such/dir').capture(limit=100)
+    except OSError:
+        pass
+
+def _compress_failed():
+    try:
+        Cmd('true', cd='/no/such/dir').capture(compress='zlib')
+    except OSError:
+        pass
+
+def _here():
+    Cmd('cat', {0: here('foo')}).capture().stdout.read()
+
+def _spawn():
+    c = Cmd('true')
+    c.spawn()
+    c.wait()
+
+def _spawn_callbacks():
+    c = Sh('echo foo; echo bar >&2')
+    c.spawn(on_stdout=len, on_stderr=len)
+    c.wait()
+
+def _follow_failed():
+    try:
+        Cmd('true', cd='/no/such/dir').spawn(on_stdout=len, on_stderr=len)
+    except OSError:
+        pass
+
+def _pipe():
+    Pipe(Cmd('echo foo'), Cmd('cat'), Cmd('wc -c')).capture().stdout.read()
+
+def _timeout():
+    Cmd('sleep 10').capture(timeout=0.001)
+
+def _kill():
+    c = Cmd('sleep 10')
+    c.spawn()
+    c.kill()
+    c.wait()
+
+def _kill_pgroup():
+    c = Sh('sleep 10 & sleep 10', pgroup=True)
+    c.spawn()
+    c.kill()
+    c.wait()
+
+def _pipe_kill():
+    p = Pipe(Cmd('yes'), Cmd('cat'), Cmd('sleep 10'), pgroup=True)
+    p.spawn()
+    p.kill()
+
+def _coproc():
+    with Coproc(Cmd('cat')) as cat:
+        cat.query('foo')
+
+## name -> (call, fraction of the iterations), the slow calls run less
+APIS = [
+    ('run', _run, 1),
+    ('capture', _capture, 1),
+    ('capture_limit', _capture_limit, 1),
+    ('limit_failed', _limit_failed, 1),
+    ('compress_failed', _compress_failed, 1),
+    ('here', _here, 1),
+    ('spawn', _spawn, 1),
+    ('spawn_callbacks', _spawn_callbacks, 1),
+    ('follow_failed', _follow_failed, 1),
+    ('pipe', _pipe, 1),
+    ('coproc', _coproc, 1),
+    ('timeout', _timeout, 0.1),
+    ('kill', _kill, 0.5),
+    ('kill_pgroup', _kill_pgroup, 0.1),
+    ('pipe_kill', _pipe_kill, 0.1),
+]
+
+
+def soak(iterations=10000, apis=None, warmup=20, checkpoints=10, out=None):
+    """
+    Call each API 'iterations' times (times its fraction) after 'warmup'
+    calls, sampling the counters 'checkpoints' times along, and return
+    a report by API name: the samples, with the number of calls so far
+    as 'calls', the elapsed time, and the leak of each counter per 1000
+    calls from the first sample to the last.  Progress goes to 'out' if
+    given.
+    """
+    report = {}
+    for name, call, fraction in APIS:
+        if apis and name not in apis:
+            continue
+        n = max(1, int(iterations * fraction))
+        for i in xrange(warmup):
+            call()
+        samples = [dict(sample(), calls=0)]
+        elapsed = 0.0
+        done = 0
+        for k in range(1, checkpoints + 1):
+            t = time.time()
+            while done < n * k // checkpoints:
+                call()
+                done += 1
+            elapsed += time.time() - t
+            samples.append(dict(sample(), calls=done))
+        before, after = samples[0], samples[-1]
+        report[name] = dict(
+            calls=n, seconds=elapsed, samples=samples,
+            per_1000=dict((k, (after[k] - before[k]) * 1000.0 / n)
+                          for k in before if k != 'calls'))
+        if out is not None:
+            out.write('%-16s %s\n' % (name, format_leaks(report[name])))
+            out.flush()
+    return report
+
+def format_leaks(entry):
+    leaks = entry['per_1000']
+    return '%6d calls %7.1fs  ' % (entry['calls'], entry['seconds']) + \
+        '  '.join('%s %+.2f' % (k, leaks[k]) for k in sorted(leaks))
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog [--iterations N] [--json] [api ...]',
+        description='APIs: ' + ', '.join(name for name, _, _ in APIS))
+    parser.add_option('-n', '--iterations', type='int', default=10000)
+    parser.add_option('--json', action='store_true',
+                      help='print the report as JSON on stdout')
+    options, apis = parser.parse_args(argv)
+    report = soak(options.iterations, apis, out=sys.stderr)
+    if options.json:
+        import json
+        json.dump(dict(report=report, time=time.time(),
+                       python=sys.version.split()[0]),
+                  sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    leaking = [name for name, entry in report.iteritems()
+               if [k for k, v in entry['per_1000'].iteritems()
+                   if v > 0 and k != 'rss_kb']]
+    return 1 if leaking else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))